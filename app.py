@@ -1,6 +1,7 @@
-from spider.up_info import UpInfoSpider
+from spider.up_info import UpInfoSpider, run_sharded
 from spider.guichu import GuichuInfoSpider
 import asyncio
+import config
 
 
 if __name__ == "__main__":
@@ -8,7 +9,12 @@ if __name__ == "__main__":
     seed_mids = {241371636, 26080061, 14889417, 364686664, 399056194}
     guichu_spider = GuichuInfoSpider()
     try:
-        asyncio.run(up_spider.run_with_mids(seed_mids))
+        if config.SPIDER_CONFIG["mode"] == "recrawl":
+            asyncio.run(up_spider.run_recrawl())
+        elif config.SPIDER_CONFIG["processes"] > 1:
+            run_sharded(seed_mids, config.SPIDER_CONFIG["processes"])
+        else:
+            asyncio.run(up_spider.run_with_mids(seed_mids))
         # asyncio.run(guichu_spider.run())
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,95 @@
+"""
+End-to-end benchmark of UpInfoSpider against the mock Bilibili api (utils/mock_server.py)
+
+    python benchmark.py [seconds] [--proxy]
+
+The mock api runs in another process, so it doesn't share the cpu of the spider.
+"""
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from aiohttp import ClientSession
+import config
+
+
+def prepare_config(data_dir: str, base: str, use_proxy: bool):
+    config.HTTP_CLIENT["api_override"] = {"api.bilibili.com": base, "bigdata.zaxtyson.cn:8086": base}
+    config.HTTP_CLIENT["cache"]["enable"] = False
+    config.PROXY_POOL.update(enable=use_proxy, type="juliang", stats_file=f"{data_dir}/proxy_stats.json")
+    config.PROXY_POOL["juliang"]["api"] = f"{base}/dynamic/getips?num=10"
+    config.MID_POOL.update(file=f"{data_dir}/mid_pool.snapshot", legacy_file=f"{data_dir}/mid_pool.json",
+                           wal_file=f"{data_dir}/mid_pool.wal")
+    config.MID_POOL["negative_cache"]["file"] = f"{data_dir}/mid_negative.cache"
+    config.SPIDER_CONFIG.update(save_path=f"{data_dir}/up_info.dat", report_interval=3600, drain_timeout=5)
+
+
+async def wait_server(base: str, timeout: float = 10) -> dict:
+    deadline = time.monotonic() + timeout
+    async with ClientSession() as session:
+        while True:
+            try:
+                async with session.get(f"{base}/_stats") as rsp:
+                    return await rsp.json()
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+
+async def run(seconds: float, data_dir: str, base: str):
+    from core.storage import storage  # after the config is prepared
+    from spider.up_info import UpInfoSpider
+    from utils.log import logger
+
+    logger.setLevel(logging.WARNING)  # no log of every mid
+    spider = UpInfoSpider()
+    seed_mids = {1, 2, 3, 5, 8, 13, 21, 34}
+    start = time.monotonic()
+    task = asyncio.create_task(spider.run_with_mids(seed_mids))
+    await asyncio.sleep(seconds)
+    # measure before stopping, the mids cancelled by stopping are not counted
+    await storage.flush()
+    elapsed = time.monotonic() - start
+    stats = await wait_server(base)
+    latency = spider._latency.summary(reset=False)
+    rate_limits = spider._client.get_rate_limit_stats()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    logger.setLevel(logging.DEBUG)
+
+    requests = sum(stats["requests"].values())
+    processed = latency["count"]
+    accepted = 0
+    if os.path.exists(config.SPIDER_CONFIG["save_path"]):
+        with open(config.SPIDER_CONFIG["save_path"]) as f:
+            accepted = sum(1 for _ in f)
+
+    print(f"time: {elapsed:.1f}s, requests: {requests}, responses: {dict(stats['responses'])}")
+    print(f"mids/sec: {processed / elapsed:.1f} ({processed} processed)")
+    print(f"accepted ups/sec: {accepted / elapsed:.1f} ({accepted} accepted)")
+    print(f"requests per accepted up: {requests / accepted if accepted else float('inf'):.1f}")
+    if processed:
+        print(f"per-up latency: p50={latency['p50']:.3f}s, p99={latency['p99']:.3f}s")
+    # the rates adjusted by AIMD, the usual bottleneck
+    for key, stat in rate_limits.items():
+        print(f"rate limit of {key}: {stat['rate']:.1f}/s, bans={stat['bans']}")
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1][0].isdigit() else 60
+    use_proxy = "--proxy" in sys.argv
+    base = f"http://{config.MOCK_SERVER['host']}:{config.MOCK_SERVER['port']}"
+    data_dir = tempfile.mkdtemp(prefix="bili_benchmark_")
+    prepare_config(data_dir, base, use_proxy)
+
+    server = subprocess.Popen([sys.executable, "-m", "utils.mock_server"], cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        asyncio.run(wait_server(base))
+        asyncio.run(run(seconds, data_dir, base))
+    finally:
+        server.terminate()
+        server.wait()
@@ -12,6 +12,40 @@ HTTP_CLIENT = {
     "timeout": {
         "total": 10,
         "connect": 5
+    },
+    # token bucket per endpoint, rate adjusted by AIMD from the ratio of 412 responses
+    "rate_limit": {
+        "enable": True,
+        # limit per (endpoint, proxy) instead of per endpoint, None: if the proxy pool is enabled,
+        # a proxy banned doesn't throttle the others
+        "per_proxy": None,
+        "initial_rate": 20,  # requests per second
+        "min_rate": 1,
+        "max_rate": 500,
+        "burst": 10,
+        "increase_step": 1,  # about +1 req/s per second without 412
+        "decrease_factor": 0.5,  # rate * 0.5 when banned
+        "decrease_cooldown": 2,  # seconds, decrease at most once in a cooldown
+        "ban_window": 10,  # seconds, the ratio of 412 is counted in a window
+        "ban_threshold": 0.05,  # decrease if more than 5% responses in the window are 412
+        "ban_min_samples": 20,  # responses in the window before the ratio is trusted
+        "idle_timeout": 600  # seconds, the limiters not used so long are evicted, like the expired proxies'
+    },
+    # send the requests of a host to another server, like {"api.bilibili.com": "http://127.0.0.1:8080"}
+    "api_override": {},
+    # responses saved on disk, reused after restart or by the retry of a failed mid
+    "cache": {
+        "enable": False,
+        "path": "data/http_cache.log",
+        "max_entries": 1000000,
+        "max_bytes": 1024 * 1024 * 1024,  # the least recently used records are evicted
+        "ttl": {  # seconds, endpoints not listed are not cached
+            "/x/space/acc/info": 7 * 86400,
+            "/x/relation/stat": 86400,
+            "/x/ugcpay-rank/elec/month/up": 86400,
+            "/x/space/arc/search": 86400,
+            "/x/relation/followings": 86400
+        }
     }
 }
 
@@ -22,13 +56,91 @@ SPIDER_FILTER = {
 
 # spider config
 SPIDER_CONFIG = {
+    "mode": "crawl",  # "crawl": find ups from seed mids, "recrawl": refresh the saved ups when they are due
     "parallel_co_tasks": 500,
+    "drain_timeout": 30,  # seconds, wait for the processing mids when stopping
+    "report_interval": 60,  # seconds, log latency of per-mid processing
+    "video_page_concurrency": 4,  # video pages of one up fetched at the same time
+    # write videos to "<save_path>.video" page by page instead of keeping them in UpInfo,
+    # the saved UpInfo has the totals only, the memory is bounded for ups with many videos
+    "stream_videos": False,
+    # processes crawling at the same time, each owns a shard of mids and has its own files with ".shard<N>" suffix
+    "processes": 1,
     "save_path": "data/up_info_test.dat"
 }
 
+# Recrawl the saved ups, every up has its own refresh interval by how often it changes
+RECRAWL = {
+    "state_file": "data/recrawl.state",
+    "base_interval": 7 * 86400,  # seconds, the first refresh interval of an up
+    "min_interval": 86400,
+    "max_interval": 90 * 86400,
+    "follower_change": 0.01,  # an up changed if it has new videos, or followers changed by 1%
+    "increase_factor": 1.5,  # interval * 1.5 if not changed
+    "decrease_factor": 0.5,  # interval * 0.5 if changed
+    "retry_delay": 3600,  # seconds, crawl a failed up again after
+    "requests_per_hour": 36000,  # budget, an up costs 3 requests + video pages
+    "save_interval": 600  # seconds
+}
+
+# Sharding, used when SPIDER_CONFIG["processes"] > 1
+SHARD = {
+    "batch_size": 1000,  # mids of other shards are sent in batches
+    "flush_interval": 1,  # seconds, send the batches even if they are not full
+    "exit_timeout": 60  # seconds, a shard still running so long after Ctrl-C is terminated
+}
+
+# Mid pool
+MID_POOL = {
+    "backend": "memory",  # "memory": in-process pool persisted to snapshot/WAL, "sqlite": shared by the nodes
+    "file": "data/mid_pool.snapshot",  # binary checkpoint
+    "legacy_file": "data/mid_pool.json",  # json history, loaded only if the snapshot is missing
+    "set_type": "bitmap",  # "set"/"bitmap", bitmap costs much less memory for a large pool
+    # "set": arbitrary order, stored in the set of "set_type" (a few MiB per 1M mids as bitmap),
+    # "priority": mids with higher score first, costs about 180 MiB per 1M mids (a dict plus a heap)
+    "frontier": "set",
+    "wal_file": "data/mid_pool.wal",  # write-ahead log, saved as <wal_file>.<generation>
+    "wal_flush_interval": 1,  # seconds
+    "checkpoint_interval": 600,  # seconds
+    "checkpoint_events": 1000000,  # take a checkpoint once so many mids are logged
+    "lease_timeout": 600,  # seconds, a mid not acked in time is added to process again
+    "retry": {
+        "max_attempts": 6,  # give up a mid after failed so many times
+        "base_delay": 30,  # seconds, delay = base_delay * 2^(attempts-1), with jitter
+        "max_delay": 3600,
+        "jitter": 0.5  # delay * [1-jitter, 1+jitter)
+    },
+    # mids dropped for too few followers, skipped in the later runs until they are due for recheck
+    "negative_cache": {
+        "file": "data/mid_negative.cache",
+        "recheck_age": 90 * 86400,  # seconds
+        # recent mids merged into the compact arrays at once, they cost about 190 MiB per 1M before merged
+        "merge_threshold": 50000
+    },
+    "sqlite": {
+        # shared by the nodes, must be on a file system with working locks (not NFS)
+        "file": "data/mid_pool.sqlite",
+        "node": None,  # name of this node in the leases, "<hostname>-<pid>" if None
+        "claim_batch": 100,  # mids claimed from the database at once
+        "poll_interval": 5,  # seconds, wait before claiming again if there is nothing to process
+        "flush_interval": 1  # seconds, acks are written in batches
+    }
+}
+
 PROXY_POOL = {
     "enable": False,
     "type": "juliang",  # "file"/"zhima"/"juliang"
+    "stats_file": "data/proxy_stats.json",  # health stats of proxies, to judge the vendors
+    "stats_dump_interval": 60,  # seconds
+    # refill the pool by the measured demand, not above pool_size
+    "refill": {
+        "min_ready": 50,  # keep at least so many ready proxies
+        "horizon": 30,  # seconds, keep enough proxies to cover the loss (ban/invalid/expire) in this time
+        "prefetch": 20,  # seconds, proxies expiring within this time are replaced in advance
+        "batch": 10,  # proxies returned by one call of the vendor api
+        "max_concurrent_fetch": 5,  # vendor api calls at the same time
+        "interval": 5  # seconds, check the pool at least once in this time
+    },
     "file": {
         "path": "data/proxies"
     },
@@ -44,9 +156,55 @@ PROXY_POOL = {
     }
 }
 
+# Storage
+STORAGE = {
+    "backend": "local",  # local: json lines, hdfs: json lines on HDFS, parquet: columnar, requires pyarrow
+    "local": {
+        # records are written in batches, flushed when any of the limits is reached
+        "max_buffer_size": 4 * 1024 * 1024,  # characters
+        "max_buffer_records": 1000,
+        "max_buffer_latency": 5  # seconds
+    },
+    "parquet": {
+        "row_group_size": 10000,  # rows of each table buffered before written as a row group
+        # a part file is closed after so many row groups, only the closed parts are readable after a crash
+        "roll_row_groups": 10,
+        "compression": "zstd"
+    }
+}
+
 # Hdfs
 HDFS = {
     # "host": "http://bigdata.zaxtyson.cn:50070/",
     "host": "http://localhost:50070/",
-    "root_path": "/user/bigdata"  # without '/' suffix
+    "root_path": "/user/bigdata",  # without '/' suffix
+    # records are appended to the part file in batches
+    "batch_size": 1024 * 1024,  # characters
+    "batch_latency": 5,  # seconds
+    # a path is a directory of part files, a new part is started when the current one is too large or too old
+    "roll_size": 128 * 1024 * 1024,  # characters
+    "roll_interval": 3600,  # seconds
+    "max_retries": 3,
+    "retry_delay": 1,  # seconds, doubled after every failure
+    "fallback_path": "data/hdfs_failed.json"  # records failed to write are saved here
+}
+
+# Mock Bilibili api for load testing, see utils/mock_server.py and benchmark.py
+MOCK_SERVER = {
+    "host": "127.0.0.1",
+    "port": 18080,  # the fake proxies listen at the ports after it
+    "api": {
+        "users": 10000000,
+        "follower_alpha": 2.3,  # about 5% of the ups have more than 10000 followers
+        "max_followings": 300,
+        "no_charge_rate": 0.7,  # code 88214
+        "latency_median": 0.05,  # seconds, log-normal distributed
+        "latency_sigma": 0.5,
+        "http_412_rate": 0.005,
+        "code_412_rate": 0.005,
+        "rate_limit": 50,  # requests per second of an ip (or proxy) before it's banned, 0 for no limit
+        "ban_duration": 30,  # seconds
+        "proxies": 50,
+        "proxy_ttl": 300  # seconds
+    }
 }
@@ -0,0 +1,109 @@
+import heapq
+from typing import Dict, Iterable, Iterator, List, Tuple
+import config
+from core.mid_set import make_mid_set
+
+__all__ = ["PriorityFrontier", "SetFrontier", "make_frontier"]
+
+
+class PriorityFrontier:
+    """
+    Mids to process, the mid with the highest score is popped first.
+    Adding a mid again increases its score, which costs O(log n):
+    the new score is pushed to the heap, the old entry is skipped when popped.
+    """
+
+    def __init__(self, mids: Iterable[int] = ()):
+        self._scores: Dict[int, float] = {}
+        self._heap: List[Tuple[float, int]] = []  # (-score, mid)
+        self.update(mids)
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def __bool__(self) -> bool:
+        return bool(self._scores)
+
+    def __contains__(self, mid: int) -> bool:
+        return mid in self._scores
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._scores)
+
+    def score(self, mid: int) -> float:
+        return self._scores.get(mid, 0.0)
+
+    def add(self, mid: int, score: float = 0.0):
+        score += self._scores.get(mid, 0.0)
+        self._scores[mid] = score
+        heapq.heappush(self._heap, (-score, mid))
+
+    def update(self, mids: Iterable[int], score: float = 0.0):
+        for mid in mids:
+            self.add(mid, score)
+        # too many outdated entries, rebuild the heap
+        if len(self._heap) > 2 * len(self._scores) + 1024:
+            self._heap = [(-score, mid) for mid, score in self._scores.items()]
+            heapq.heapify(self._heap)
+
+    def discard(self, mid: int):
+        self._scores.pop(mid, None)
+
+    def pop(self) -> int:
+        while self._heap:
+            neg_score, mid = heapq.heappop(self._heap)
+            if self._scores.get(mid) == -neg_score:  # skip outdated entries
+                del self._scores[mid]
+                if not self._scores:
+                    self._heap.clear()  # only outdated entries left
+                return mid
+        raise KeyError("pop from an empty PriorityFrontier")
+
+    def copy(self) -> "PriorityFrontier":
+        other = PriorityFrontier()
+        other._scores = self._scores.copy()
+        other._heap = self._heap.copy()
+        return other
+
+
+class SetFrontier:
+    """Mids to process in arbitrary order, the score is ignored"""
+
+    def __init__(self, mids: Iterable[int] = ()):
+        self._mids = make_mid_set(mids)
+
+    def __len__(self) -> int:
+        return len(self._mids)
+
+    def __bool__(self) -> bool:
+        return bool(self._mids)
+
+    def __contains__(self, mid: int) -> bool:
+        return mid in self._mids
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._mids)
+
+    def add(self, mid: int, score: float = 0.0):
+        self._mids.add(mid)
+
+    def update(self, mids: Iterable[int], score: float = 0.0):
+        self._mids.update(mids)
+
+    def discard(self, mid: int):
+        self._mids.discard(mid)
+
+    def pop(self) -> int:
+        return self._mids.pop()
+
+    def copy(self) -> "SetFrontier":
+        other = SetFrontier()
+        other._mids = self._mids.copy()
+        return other
+
+
+def make_frontier(mids: Iterable[int] = ()):
+    """Create the frontier for MidPool, the implementation is chosen by config"""
+    if config.MID_POOL.get("frontier") == "priority":
+        return PriorityFrontier(mids)
+    return SetFrontier(mids)
@@ -1,6 +1,8 @@
 import asyncio
 import os
+import time
 from typing import Optional
+from urllib.parse import urlparse
 
 from aiohttp import ClientSession, ClientTimeout, AsyncResolver, TCPConnector
 from aiohttp.client_exceptions import ClientConnectionError, ClientHttpProxyError
@@ -8,6 +10,8 @@ import config
 from utils.log import logger
 from utils.useragent import get_random_ua
 from core.proxy_pool import ProxyPool
+from core.rate_limiter import AimdRateLimiter
+from core.response_cache import ResponseCache
 
 __all__ = ["HttpClient"]
 
@@ -19,7 +23,7 @@ if os.name == "nt":
 
 class HttpClient:
 
-    def __init__(self):
+    def __init__(self, use_cache: bool = True):
         self._session: Optional[ClientSession] = None
         self._proxy_pool = None
 
@@ -30,8 +34,22 @@ class HttpClient:
         )
         self._dns_server = config.HTTP_CLIENT.get("dns_server")
         self._enable_proxy_pool = config.PROXY_POOL.get("enable")
+        self._rate_limiter = None
+        rate_limit = config.HTTP_CLIENT.get("rate_limit").copy()
+        if rate_limit.pop("enable"):
+            self._rate_limit_per_proxy = rate_limit.pop("per_proxy")
+            if self._rate_limit_per_proxy is None:
+                self._rate_limit_per_proxy = self._enable_proxy_pool
+            self._rate_limiter = AimdRateLimiter(**rate_limit)
+        self._api_override = config.HTTP_CLIENT.get("api_override")
+        self._cache = None
+        cache = config.HTTP_CLIENT.get("cache").copy()
+        if cache.pop("enable") and use_cache:
+            self._cache = ResponseCache(**cache)
 
     async def init(self):
+        if self._cache:
+            await self._cache.open()
         if self._dns_server:
             logger.info(f"Use custom DNS server: {self._dns_server}")
 
@@ -48,6 +66,8 @@ class HttpClient:
             self._proxy_pool.start_update_proxy_task()
 
     async def close(self):
+        if self._cache:
+            await self._cache.close()
         if self._session:
             await self._session.close()
             logger.info("HttpClient session is closed")
@@ -66,37 +86,82 @@ class HttpClient:
         else:
             kwargs.setdefault("headers", {"User-Agent": get_random_ua()})
 
+    def report(self):
+        if self._rate_limiter:
+            self._rate_limiter.report()
+        if self._cache:
+            self._cache.report()
+
+    def get_rate_limit_stats(self) -> dict:
+        return self._rate_limiter.stats() if self._rate_limiter else {}
+
     async def get_json_data(self, url: str, **kwargs) -> Optional[dict]:
+        if not self._cache:
+            return await self.__fetch_json_data(url, **kwargs)
+        # the data fetched before restart or retry is reused
+        params = kwargs.get("params")
+        if (data := self._cache.get(url, params)) is not None:
+            return data
+        data = await self.__fetch_json_data(url, **kwargs)
+        if data is not None:
+            self._cache.put(url, params, data)
+        return data
+
+    async def __fetch_json_data(self, url: str, **kwargs) -> Optional[dict]:
         retry_times = config.HTTP_CLIENT.get("retry_times")
+        parsed_url = urlparse(url)
+        endpoint = parsed_url.path
+        if base := self._api_override.get(parsed_url.netloc):
+            url = base + url[url.index(parsed_url.netloc) + len(parsed_url.netloc):]
         for _ in range(retry_times):
             proxy = None
             if self._enable_proxy_pool:
                 proxy = await self._proxy_pool.get_random_proxy()
-                kwargs.setdefault("proxy", proxy.get_proxy())
+                kwargs["proxy"] = proxy.get_proxy()  # a new proxy for each retry
             self.__set_request_args(kwargs)
+            limiter_key = endpoint
+            if self._rate_limiter:
+                if self._rate_limit_per_proxy:
+                    limiter_key = (endpoint, kwargs.get("proxy"))
+                await self._rate_limiter.acquire(limiter_key)
+            start = time.perf_counter()
             try:
                 async with self._session.get(url, **kwargs) as r:
                     if not r or r.status != 200:  # 412
                         if proxy:
+                            proxy.record(time.perf_counter() - start, success=False, banned=r.status == 412)
                             proxy.add_ban_times()
+                        if self._rate_limiter and r.status == 412:
+                            self._rate_limiter.on_ban(limiter_key)
                         continue
+                    body = await r.read()
                     rsp_json = await r.json(content_type=None)
                     code = rsp_json["code"]
+                    if proxy:
+                        proxy.record(time.perf_counter() - start, success=code != -412,
+                                     banned=code == -412, nbytes=len(body))
+                    if code in (0, 88214) and self._rate_limiter:
+                        self._rate_limiter.on_success(limiter_key)
                     if code == 0:
                         return rsp_json["data"]
                     elif code == 88214:  # up主未开通充电
                         return {}
                     elif code == -412:  # request ban
-                        proxy.add_ban_times()
+                        if proxy:
+                            proxy.add_ban_times()
+                        if self._rate_limiter:
+                            self._rate_limiter.on_ban(limiter_key)
                         continue
                     else:
                         logger.debug(f"Error, {url=}, {kwargs=} {rsp_json=}")
                         return None
             except (ClientConnectionError, ClientHttpProxyError) as e:
                 if proxy:
+                    proxy.record(time.perf_counter() - start, success=False)
                     proxy.mark_as_invalid(e)
             except asyncio.exceptions.TimeoutError as e:  # e is ""
                 if proxy:
+                    proxy.record(time.perf_counter() - start, success=False)
                     proxy.mark_as_invalid("Timeout")
             except Exception as e:
                 logger.exception(e)
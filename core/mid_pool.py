@@ -1,162 +1,454 @@
-from typing import Set
+from collections import defaultdict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set
 import asyncio
+import config
+import os
+import time
+from core.frontier import make_frontier
+from core.mid_set import make_mid_set
+from core.negative_cache import NegativeCache
+from core.mid_pool_wal import *
+from core.mid_pool_snapshot import *
+from core.retry_scheduler import RetryScheduler
+from core.sqlite_mid_pool import SqliteMidPool
 from utils.log import logger
-import random
-import signal
 import json
 
-__all__ = ["MidPool"]
+__all__ = ["MidPool", "make_mid_pool"]
 
 
 class MidPool:
 
     def __init__(self) -> None:
-        self._mid_to_process = set()
-        self._mid_processed = set()
-        self._mid_failed = set()
+        self._mid_to_process = make_frontier()
+        self._mid_processed = make_mid_set()
+        self._mid_failed = make_mid_set()  # waiting for retry
+        self._mid_dead = make_mid_set()  # failed too many times, given up
+        self._mid_pending: Dict[int, float] = {}  # mid -> score, added before the history is loaded
+        self._loaded = False
+        self._load_error = None  # the history can't be loaded, the pool is unusable
+        self._need_checkpoint = False
+        self._bg_load_task = None
         self._bg_retry_task = None
-        self._lock = None
-        self._cond = None
-        self._file = "data/mid_pool.json"
+        self._bg_persist_task = None
+        self._waiters: Deque[asyncio.Future] = deque()  # workers waiting for a mid
+        self._mid_leased: Dict[int, float] = {}  # mid -> lease deadline, handed out but not acked yet
+        self._lease_timeout = config.MID_POOL.get("lease_timeout")
+        self._bg_lease_task = None
+        self._draining = False
+        self._drained = None
+        self._file = config.MID_POOL.get("file")
+        self._legacy_file = config.MID_POOL.get("legacy_file")
+        self._wal = MidPoolWal(config.MID_POOL.get("wal_file"))
+        self._wal_flush_interval = config.MID_POOL.get("wal_flush_interval")
+        self._checkpoint_interval = config.MID_POOL.get("checkpoint_interval")
+        self._checkpoint_events = config.MID_POOL.get("checkpoint_events")
+        self._retry_scheduler = RetryScheduler(**config.MID_POOL.get("retry"))
+        self._negative_cache = NegativeCache(**config.MID_POOL.get("negative_cache"))
+        self._retry_event = None
+        self._before_flush = None
 
-    def init(self, loop=None):
-        if loop:
-            self._lock = asyncio.Lock(loop)
-        else:
-            self._lock = asyncio.Lock()  # use current running loop
-        self._cond = asyncio.Condition(self._lock)
+    def init(self, before_flush: Optional[Callable[[], Awaitable]] = None):
+        """`before_flush` flushes the output, it's awaited before the acks are persisted"""
+        self._before_flush = before_flush
+        # all the pool operations are done in one event loop without await inside,
+        # so no lock is needed, a new mid is handed to a waiter directly
+        self._retry_event = asyncio.Event()
+        self._drained = asyncio.Event()
+
+        # new events go to a new log, the older ones are replayed after loading the snapshot
+        self._wal.open(self._wal.latest_generation() + 1)
 
-        # load history data
-        self.__load()
+        # load history data in background, workers can get mids before it's finished
+        self._bg_load_task = asyncio.create_task(self.__load())
+        self._bg_load_task.set_name("MidPoolLoadTask")
 
         # start background task
         self._bg_retry_task = asyncio.create_task(
             self.__failed_mid_retry_task())
         self._bg_retry_task.set_name("FailedMidRetryTask")
+        self._bg_persist_task = asyncio.create_task(self.__persist_task())
+        self._bg_persist_task.set_name("MidPoolPersistTask")
+        self._bg_lease_task = asyncio.create_task(self.__lease_timeout_task())
+        self._bg_lease_task.set_name("MidLeaseTimeoutTask")
+
+    async def __load(self):
+        try:
+            await self.__load_history()
+        except Exception as e:
+            # never go on without the history, the next checkpoint would overwrite it
+            logger.error(f"MidPool failed to load history, stop the spider: {e!r}")
+            self._load_error = e
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if not waiter.done():
+                    waiter.set_exception(e)
+
+    async def __load_history(self):
+        start = time.monotonic()
+        await self._negative_cache.load()
+        generation = 0
+        if os.path.exists(self._file):
+            generation = await self.__load_snapshot()
+        elif os.path.exists(self._legacy_file):
+            await self.__load_legacy_file()
+            self._need_checkpoint = True  # convert to snapshot
+        else:
+            logger.info(f"MidPool history file not found: {self._file}")
+        await self.__replay(generation, self._wal.generation - 1)
+
+        # failed mids in history are retried from the first attempt
+        for mid in self._mid_failed:
+            if not self._retry_scheduler.attempts(mid):
+                self._retry_scheduler.schedule(mid)
+        self._retry_event.set()
+
+        # mids discovered while loading can be filtered now
+        self._loaded = True
+        pending = defaultdict(set)
+        for mid, score in self._mid_pending.items():
+            pending[score].add(mid)
+        for score, mids in pending.items():
+            await self.add_mid_set(mids, score)
+        self._mid_pending = {}
+        logger.info(f"MidPool loaded in {time.monotonic() - start:.2f}s, "
+                    f"{len(self._mid_to_process)} to process, {len(self._mid_processed)} processed, "
+                    f"{len(self._mid_failed)} failed, {len(self._mid_dead)} dead")
+
+    async def __load_snapshot(self) -> int:
+        logger.info(f"Load MidPool snapshot from file: {self._file}")
+        reader = SnapshotReader(self._file)
+        blocks = reader.blocks()
+        sections = {
+            SECTION_TO_PROCESS: self._mid_to_process,
+            SECTION_PROCESSED: self._mid_processed,
+            SECTION_FAILED: self._mid_failed,
+            SECTION_DEAD: self._mid_dead
+        }
+        # read and decode blocks in a thread, merge them in the loop
+        while block := await asyncio.to_thread(next, blocks, None):
+            section, mids = block
+            sections[section].update(mids)
+            if section == SECTION_TO_PROCESS:
+                self.__wakeup_waiters()
+        return reader.generation
+
+    async def __load_legacy_file(self):
+        logger.info(f"Load MidPool history from legacy file: {self._legacy_file}")
+
+        def load_json():
+            with open(self._legacy_file, "r") as f:
+                return json.load(f)
+
+        data = await asyncio.to_thread(load_json)
+        self._mid_processed.update(data["mid_processed"])
+        self._mid_failed.update(data["mid_failed"])
+        self._mid_to_process.update(data["mid_to_process"])
+        self.__wakeup_waiters()
+
+    async def __replay(self, first: int, last: int):
+        count = 0
+        for i, (op, mids) in enumerate(self._wal.replay(first, last)):
+            count += len(mids)
+            if op == OP_ADD:
+                self._mid_to_process.update(
+                    mid for mid in mids
+                    if mid not in self._mid_processed and mid not in self._mid_failed and mid not in self._mid_dead)
+            elif op == OP_PROCESSED:
+                for mid in mids:
+                    self._mid_to_process.discard(mid)
+                    self._mid_failed.discard(mid)
+                    self._mid_processed.add(mid)
+            else:
+                # a mid processed in this session may be failed in older logs
+                mids = [mid for mid in mids if mid not in self._mid_processed]
+                if op == OP_FAILED:
+                    for mid in mids:
+                        self._mid_to_process.discard(mid)
+                        self._mid_failed.add(mid)
+                elif op == OP_RETRY:
+                    for mid in mids:
+                        self._mid_failed.discard(mid)
+                    self._mid_to_process.update(mids)
+                elif op == OP_DEAD:
+                    for mid in mids:
+                        self._mid_to_process.discard(mid)
+                        self._mid_failed.discard(mid)
+                        self._mid_dead.add(mid)
+            if i % 1000 == 0:
+                await asyncio.sleep(0)  # don't block workers
+        logger.info(f"Replay {count} mid event(s) from MidPool WAL, "
+                    f"total {len(self._mid_to_process)} mid(s) to process")
+
+    async def __checkpoint(self):
+        # events after rotation go to the new log, which is replayed on top of this checkpoint
+        generation = await self._wal.rotate()
+        # copying is much faster than encoding, encode the copies in a thread
+        to_process = self._mid_to_process.copy()
+        to_process.update(self._mid_leased)  # not acked yet, process them again after restart
+        sections = {
+            SECTION_TO_PROCESS: to_process,
+            SECTION_PROCESSED: self._mid_processed.copy(),
+            SECTION_FAILED: self._mid_failed.copy(),
+            SECTION_DEAD: self._mid_dead.copy()
+        }
+        logger.info(f"Dump MidPool snapshot to file: {self._file}")
+        await asyncio.to_thread(write_snapshot, self._file, generation, sections)
+        self._wal.remove_before(generation)
 
-    def __load(self):
-        logger.info(f"Load MidPool history from file: {self._file}")
-        with open(self._file, "r") as f:
-            data = json.load(f)
-            self._mid_to_process = set(data["mid_to_process"])
-            self._mid_processed = set(data["mid_processed"])
-            self._mid_failed = set(data["mid_failed"])
-
-    def __dump(self):
-        logger.info(f"Dump MidPool history to file: {self._file}")
-        with open(self._file, "w+") as f:
-            data = {
-                "mid_to_process": list(self._mid_to_process),
-                "mid_processed": list(self._mid_processed),
-                "mid_failed": list(self._mid_failed)
-            }
-            json.dump(data, f)
+    async def __persist_task(self):
+        logger.info("MidPool persist task running...")
+        last_checkpoint = time.monotonic()
+        while True:
+            await asyncio.sleep(self._wal_flush_interval)
+            # an acked mid is durable only after its record is, flush the storage first
+            await self._wal.flush(self._before_flush)
+            await self._negative_cache.flush()
+            if not self._loaded:
+                continue
+            if self._need_checkpoint or self._wal.events >= self._checkpoint_events \
+                    or time.monotonic() - last_checkpoint >= self._checkpoint_interval:
+                self._need_checkpoint = False
+                await self.__checkpoint()
+                last_checkpoint = time.monotonic()
 
     def stop(self):
         logger.info("Stop MidPool...")
-        if not self._bg_retry_task.cancelled():
-            self._bg_retry_task.cancel()
-        self.__dump()
+        for task in (self._bg_load_task, self._bg_retry_task, self._bg_persist_task, self._bg_lease_task):
+            if not task.cancelled():
+                task.cancel()
+        # all events are in WAL, no need to dump the whole pool
+        self._wal.close()
+        self._negative_cache.close()
+
+    def __wakeup_waiters(self):
+        # hand mids to waiters one by one, instead of waking all of them up to compete
+        while self._waiters and self._mid_to_process and not self._draining:
+            waiter = self._waiters.popleft()
+            if not waiter.done():  # skip the cancelled
+                waiter.set_result(self.__lease())
+
+    def __lease(self) -> int:
+        # leases are created with the same timeout, so the dict is ordered by deadline
+        mid = self._mid_to_process.pop()
+        self._mid_leased.pop(mid, None)
+        self._mid_leased[mid] = time.monotonic() + self._lease_timeout
+        return mid
+
+    def __ack(self, mid: int):
+        self._mid_leased.pop(mid, None)
+        self.__check_drained()
+
+    def __check_drained(self):
+        if self._draining and not self._mid_leased:
+            self._drained.set()
+
+    async def __lease_timeout_task(self):
+        logger.info("Mid lease timeout task running...")
+        while True:
+            await asyncio.sleep(self._lease_timeout / 10)
+            now = time.monotonic()
+            expired = []
+            for mid, deadline in self._mid_leased.items():
+                if deadline > now:
+                    break
+                expired.append(mid)
+            if not expired:
+                continue
+            logger.warning(f"Lease of {len(expired)} mid(s) timeout, add them to process again")
+            for mid in expired:
+                del self._mid_leased[mid]
+            self.__check_drained()
+            self._mid_to_process.update(
+                mid for mid in expired
+                if mid not in self._mid_processed and mid not in self._mid_failed and mid not in self._mid_dead)
+            self.__wakeup_waiters()
+
+    async def drain(self, timeout: float):
+        """Stop handing out mids, and wait for the leased mids to be acked until timeout"""
+        self._draining = True
+        if not self._mid_leased:
+            return
+        logger.info(f"Drain MidPool, wait for {len(self._mid_leased)} leased mid(s), {timeout=}s")
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout)
+            logger.info("MidPool is drained")
+        except asyncio.TimeoutError:
+            # they are still in the snapshot/WAL, will be processed in the next run
+            logger.warning(f"Drain MidPool timeout, {len(self._mid_leased)} leased mid(s) are not acked")
 
     async def add_processed_mid(self, mid: int):
-        async with self._cond:
-            logger.debug(f"Add a proceed {mid=}")
-            self._mid_processed.add(mid)
-
-    async def add_mid_set(self, mids: Set[int]):
-        async with self._cond:
-            to_process = mids - self._mid_processed - self._mid_failed
-            if len(to_process) > 0:
-                self._mid_to_process.update(to_process)
-                logger.info(
-                    f"Add {len(to_process)} mid(s), total {len(self._mid_to_process)} mid(s) to process")
-                self._cond.notify_all()
+        logger.debug(f"Add a proceed {mid=}")
+        self.__ack(mid)
+        self._mid_processed.add(mid)
+        self._retry_scheduler.forget(mid)
+        self._wal.append(OP_PROCESSED, (mid,))
+
+    async def add_dropped_mid(self, mid: int, follower: int):
+        """The mid is processed but dropped for too few followers, skip it in the later runs"""
+        await self.add_processed_mid(mid)
+        self._negative_cache.add(mid, follower)
+
+    async def add_mid_set(self, mids: Set[int], score: float = 1.0):
+        """
+        Add mids to process, the mids with higher score are processed first (priority frontier).
+        Adding a mid to process again increases its score.
+        """
+        if not self._loaded:
+            for mid in mids:
+                self._mid_pending[mid] = self._mid_pending.get(mid, 0.0) + score
+            return
+        to_process = mids - self._mid_processed - self._mid_failed - self._mid_dead
+        # known tiny accounts are skipped until they are due for recheck
+        to_process = self._negative_cache.filter(to_process)
+        if len(to_process) > 0:
+            self._mid_to_process.update(to_process, score)
+            self._wal.append(OP_ADD, to_process)
+            logger.info(
+                f"Add {len(to_process)} mid(s), total {len(self._mid_to_process)} mid(s) to process")
+            self.__wakeup_waiters()
 
     async def add_failed_mid(self, mid: int):
-        async with self._lock:
-            logger.warning(f"Add failed {mid=}")
+        self.__ack(mid)
+        if self._retry_scheduler.schedule(mid):
+            logger.warning(f"Add failed {mid=}, attempts={self._retry_scheduler.attempts(mid)}")
             self._mid_failed.add(mid)
+            self._wal.append(OP_FAILED, (mid,))
+            self._retry_event.set()  # the new one may be due earlier
+        else:
+            logger.error(f"Give up failed {mid=}")
+            self._mid_failed.discard(mid)
+            self._mid_dead.add(mid)
+            self._wal.append(OP_DEAD, (mid,))
 
     async def __failed_mid_retry_task(self):
-        logger.info("Scan failed mid set task running...")
+        logger.info("Failed mid retry task running...")
         while True:
-            await asyncio.sleep(10)
-            logger.info("Scan falied mid set...")
-            async with self._cond:
-                if len(self._mid_failed) > 0:
-                    logger.info(
-                        f"Add {len(self._mid_failed)} failed mid(s) to retry list")
-                    self._mid_to_process.update(self._mid_failed)
-                    self._mid_failed.clear()
-                    self._cond.notify_all()
+            # sleep until the next retry is due, or a new failed mid is scheduled
+            try:
+                await asyncio.wait_for(self._retry_event.wait(), self._retry_scheduler.next_due())
+            except asyncio.TimeoutError:
+                pass
+            self._retry_event.clear()
+            mids = [mid for mid in self._retry_scheduler.pop_due() if mid in self._mid_failed]
+            if not mids:
+                continue
+            logger.info(f"Add {len(mids)} failed mid(s) to retry list, "
+                        f"{len(self._retry_scheduler)} mid(s) waiting for retry")
+            for mid in mids:
+                self._mid_failed.discard(mid)
+            self._mid_to_process.update(mids)
+            self._wal.append(OP_RETRY, mids)
+            self.__wakeup_waiters()
 
     async def get_mid(self) -> int:
-        async with self._cond:
-            while len(self._mid_to_process) == 0:
-                logger.info("Wait a mid...")
-                await self._cond.wait()
-            return self._mid_to_process.pop()
+        """Get a mid to process, it must be acked by add_processed_mid/add_failed_mid"""
+        if self._load_error:
+            raise self._load_error
+        if self._mid_to_process and not self._waiters and not self._draining:
+            return self.__lease()
+
+        logger.debug("Wait a mid...")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            # cancelled after a mid is handed over, put it back
+            if waiter.done() and not waiter.cancelled():
+                self.__ack(waiter.result())
+                self._mid_to_process.add(waiter.result())
+                self.__wakeup_waiters()
+            raise
+
+    async def get_many(self, n: int) -> List[int]:
+        """Get 1~n mids, wait if there is no mid to process"""
+        mids = [await self.get_mid()]
+        while len(mids) < n and self._mid_to_process and not self._draining:
+            mids.append(self.__lease())
+        return mids
+
+
+def make_mid_pool():
+    """Create the MidPool, the backend is chosen by config"""
+    if config.MID_POOL.get("backend") == "sqlite":
+        return SqliteMidPool()
+    return MidPool()
+
 
 # ============ for test ===============
 
 
 if __name__ == "__main__":
-    mid_pool = MidPool()
+    import tempfile
 
-    def gen_random_mid():
-        return random.randint(9000, 10000)
+    class ConditionMidPool:
+        """The frontier before direct handoff: one condition, notify_all on every add"""
 
-    def gen_random_mid_set():
-        mids = set()
-        for _ in range(100):
-            mids.add(gen_random_mid())
-        return mids
+        def __init__(self):
+            self._mid_to_process = set()
+            self._mid_processed = set()
+            self._mid_failed = set()
+            self._lock = asyncio.Lock()
+            self._cond = asyncio.Condition(self._lock)
 
-    async def single_task(tid: int):
-        while True:
-            logger.info(f"[{tid}] Try to get a mid...")
-            mid = await mid_pool.get_mid()
-            logger.info(f"[{tid}] Got a mid {mid}")
-            await asyncio.sleep(0.1)
-            # simulate do filter
-            if mid < 9100:
-                logger.info(f"[{tid}] Drop mid {mid}")
-            elif 9600 < mid < 9650:
-                logger.error(f"Process {mid=} failed!")
-                await mid_pool.add_failed_mid(mid)  # failed!
-            else:
-                # get info of mid...
-                # get following of mid
-                await mid_pool.add_mid_set(gen_random_mid_set())
-
-    async def parallel_task():
-        co_tasks = [single_task(i) for i in range(100)]
-        await asyncio.gather(
-            *co_tasks
-        )
-
-    task = None
-    stop_task = False
-
-    def sig_handler(signum, frame):
-        global task
-        global stop_task
-        logger.info(f"Recv signal: {signum}")
-        mid_pool.stop()
-        if not task.cancelled():
+        async def add_processed_mid(self, mid: int):
+            async with self._cond:
+                self._mid_processed.add(mid)
+
+        async def add_mid_set(self, mids: Set[int]):
+            async with self._cond:
+                to_process = mids - self._mid_processed - self._mid_failed
+                if len(to_process) > 0:
+                    self._mid_to_process.update(to_process)
+                    self._cond.notify_all()
+
+        async def get_mid(self) -> int:
+            async with self._cond:
+                while len(self._mid_to_process) == 0:
+                    await self._cond.wait()
+                return self._mid_to_process.pop()
+
+    async def benchmark(pool, workers: int, total: int) -> float:
+        # every processed mid discovers 1 new mid, so most of the workers are waiting
+        next_mid = iter(range(workers, 10 ** 9))
+        done = asyncio.Event()
+        count = 0
+
+        async def single_task():
+            nonlocal count
+            while True:
+                mid = await pool.get_mid()
+                await asyncio.sleep(0)  # simulate requests
+                await pool.add_processed_mid(mid)
+                await pool.add_mid_set({next(next_mid)})
+                count += 1
+                if count >= total:
+                    done.set()
+
+        await pool.add_mid_set(set(range(workers // 10)))
+        start = time.perf_counter()
+        tasks = [asyncio.create_task(single_task()) for _ in range(workers)]
+        await done.wait()
+        cost = time.perf_counter() - start
+        for task in tasks:
             task.cancel()
-        stop_task = True
-        print("Task canceled")
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return count / cost
 
     async def main():
-        global task
-        mid_pool.init()
-        seed_mid = 9800
-        await mid_pool.add_mid(seed_mid)
-        task = asyncio.create_task(parallel_task())
-        while not stop_task:
-            await asyncio.sleep(1)
-
-    signal.signal(signal.SIGINT, sig_handler)
+        logger.setLevel("WARNING")
+        for workers in (500, 5000):
+            tmp_dir = tempfile.mkdtemp()
+            config.MID_POOL.update(file=f"{tmp_dir}/mid_pool.snapshot", wal_file=f"{tmp_dir}/mid_pool.wal")
+            mid_pool = MidPool()
+            mid_pool.init()
+            await mid_pool._bg_load_task
+            qps = await benchmark(mid_pool, workers, 100000)
+            mid_pool.stop()
+            print(f"[MidPool] workers={workers}, get+add: {qps:.0f} mid/s")
+
+            qps = await benchmark(ConditionMidPool(), workers, 100000 if workers < 1000 else 20000)
+            print(f"[ConditionMidPool] workers={workers}, get+add: {qps:.0f} mid/s")
+
     asyncio.run(main())
-    print("finished")
@@ -0,0 +1,98 @@
+import os
+import struct
+import sys
+import zlib
+from array import array
+from itertools import accumulate, islice
+from operator import sub
+from typing import Dict, Iterable, Iterator, Tuple
+
+__all__ = ["write_snapshot", "SnapshotReader",
+           "SECTION_TO_PROCESS", "SECTION_PROCESSED", "SECTION_FAILED", "SECTION_DEAD"]
+
+# Binary snapshot of MidPool:
+#   header: magic + uint64 WAL generation
+#   blocks: (section tag, mids count, data size) + zlib(int64 deltas of sorted mids)
+#   end:    a block with empty section tag
+# Each block is decoded on its own, so the snapshot can be loaded block by block.
+_MAGIC = b"MIDPOOL\x01"
+_HEADER = struct.Struct("<Q")
+_BLOCK = struct.Struct("<cII")
+_BLOCK_SIZE = 16384  # mids per block
+_END = b"\x00"
+
+# section tags
+SECTION_TO_PROCESS = "t"
+SECTION_PROCESSED = "p"
+SECTION_FAILED = "f"
+SECTION_DEAD = "d"
+
+
+def _to_little_endian(data: array) -> array:
+    if sys.byteorder == "big":
+        data.byteswap()
+    return data
+
+
+def _encode_block(mids: array) -> bytes:
+    deltas = array("q", islice(mids, 1))
+    deltas.extend(map(sub, islice(mids, 1, None), mids))
+    return zlib.compress(_to_little_endian(deltas).tobytes(), 1)
+
+
+def _decode_block(data: bytes) -> array:
+    try:
+        data = zlib.decompress(data)
+    except zlib.error as e:
+        raise ValueError(f"Broken MidPool snapshot block: {e}") from e
+    deltas = _to_little_endian(array("q", data))
+    return array("q", accumulate(deltas))
+
+
+def write_snapshot(path: str, generation: int, sections: Dict[str, Iterable[int]]):
+    """Write sections of mids to the snapshot file atomically, it's slow, call it in a thread"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_MAGIC)
+        f.write(_HEADER.pack(generation))
+        for section, mids in sections.items():
+            tag = section.encode()
+            # stream the mids block by block, never hold the whole section in a list.
+            # MidBitmap is iterated in order, sorting its blocks again is O(n);
+            # a set/PriorityFrontier is sorted within each block, the blocks are decoded on their own
+            it = iter(mids)
+            while block := array("q", sorted(islice(it, _BLOCK_SIZE))):
+                data = _encode_block(block)
+                f.write(_BLOCK.pack(tag, len(block), len(data)))
+                f.write(data)
+        f.write(_BLOCK.pack(_END, 0, 0))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class SnapshotReader:
+    """Read a snapshot block by block"""
+
+    def __init__(self, path: str):
+        self._path = path
+        self._file = open(path, "rb")
+        if self._file.read(len(_MAGIC)) != _MAGIC:
+            self._file.close()
+            raise ValueError(f"Not a MidPool snapshot: {path}")
+        self.generation, = _HEADER.unpack(self._file.read(_HEADER.size))
+
+    def blocks(self) -> Iterator[Tuple[str, array]]:
+        """Yield (section, mids) in the order of writing"""
+        with self._file as f:
+            while True:
+                header = f.read(_BLOCK.size)
+                if len(header) < _BLOCK.size:
+                    raise ValueError(f"MidPool snapshot is truncated: {self._path}")
+                tag, count, size = _BLOCK.unpack(header)
+                if tag == _END:
+                    return
+                mids = _decode_block(f.read(size))
+                if len(mids) != count:
+                    raise ValueError(f"MidPool snapshot is broken: {self._path}")
+                yield tag.decode(), mids
@@ -0,0 +1,136 @@
+import asyncio
+import glob
+import os
+from collections import deque
+from threading import RLock
+from typing import Awaitable, Callable, Deque, Iterable, Iterator, List, Optional, Tuple
+from utils.log import logger
+
+__all__ = ["MidPoolWal", "OP_ADD", "OP_PROCESSED", "OP_FAILED", "OP_RETRY", "OP_DEAD"]
+
+# WAL record: "<op> <mid> <mid> ...\n"
+OP_ADD = "a"  # mids added to process
+OP_PROCESSED = "p"  # mids processed
+OP_FAILED = "f"  # mids failed
+OP_RETRY = "r"  # failed mids moved back to process
+OP_DEAD = "d"  # failed mids given up
+
+
+class MidPoolWal:
+    """
+    Append-only write-ahead log of MidPool events.
+    The log is split into generations (<path>.<generation>), a checkpoint of MidPool
+    records the generation it was taken at, so recovery = checkpoint + replay of the
+    logs since that generation, and the older logs can be removed safely.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._generation = 0
+        self._file = None
+        self._buffer: List[str] = []
+        self._pending: Deque[str] = deque()  # swapped out of the buffer, waiting to be written in order
+        self._lock = RLock()  # the file is written in a thread, and closed in the loop
+        self._events = 0  # mids logged in current generation
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def events(self) -> int:
+        return self._events
+
+    def __log_file(self, generation: int) -> str:
+        return f"{self._path}.{generation}"
+
+    def __generations(self) -> List[int]:
+        generations = []
+        for file in glob.glob(f"{glob.escape(self._path)}.*"):
+            suffix = file.rsplit(".", 1)[-1]
+            if suffix.isdigit():
+                generations.append(int(suffix))
+        return sorted(generations)
+
+    def latest_generation(self) -> int:
+        generations = self.__generations()
+        return generations[-1] if generations else 0
+
+    def replay(self, first: int, last: int) -> Iterator[Tuple[str, List[int]]]:
+        """Read events from the logs of generation [first, last]"""
+        for gen in self.__generations():
+            if not first <= gen <= last:
+                continue
+            file = self.__log_file(gen)
+            logger.info(f"Replay MidPool WAL: {file}")
+            with open(file, "r") as f:
+                for line in f:
+                    op, _, mids = line.partition(" ")
+                    # the last record may be partially written before a crash
+                    if not line.endswith("\n") or op not in (OP_ADD, OP_PROCESSED, OP_FAILED, OP_RETRY, OP_DEAD):
+                        logger.warning(f"Skip broken WAL record in {file}: {line[:50]!r}")
+                        continue
+                    yield op, list(map(int, mids.split()))
+
+    def open(self, generation: int):
+        self._generation = generation
+        self._file = open(self.__log_file(generation), "a", encoding="utf-8")
+        self._events = 0
+
+    def append(self, op: str, mids: Iterable[int]):
+        record = " ".join(map(str, mids))
+        if not record:
+            return
+        self._buffer.append(f"{op} {record}\n")
+        self._events += record.count(" ") + 1
+
+    def __swap_buffer(self):
+        if self._buffer:
+            self._pending.append("".join(self._buffer))
+            self._buffer = []
+
+    def __write_pending(self):
+        # whoever holds the lock writes all the pending records, so they are never reordered
+        with self._lock:
+            if not self._pending or not self._file:
+                return
+            while self._pending:
+                self._file.write(self._pending.popleft())
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    async def flush(self, before_write: Optional[Callable[[], Awaitable]] = None):
+        """
+        Write the buffered events, `before_write` is awaited between taking the events and writing them,
+        the events appended meanwhile are left for the next flush.
+        """
+        # fsync may take long on a slow disk, don't block the event loop
+        self.__swap_buffer()
+        if self._pending:
+            if before_write:
+                await before_write()
+            await asyncio.to_thread(self.__write_pending)
+
+    async def rotate(self) -> int:
+        """Switch to a new log generation, events after this call go to the new log"""
+        await self.flush()
+        # the events appended while flushing are still buffered, they go to the new log
+        with self._lock:
+            self._file.close()
+            self.open(self._generation + 1)
+        return self._generation
+
+    def remove_before(self, generation: int):
+        for gen in self.__generations():
+            if gen < generation:
+                os.remove(self.__log_file(gen))
+                logger.debug(f"Remove MidPool WAL: {self.__log_file(gen)}")
+
+    def close(self):
+        # a flush cancelled on stop may still be writing, wait for it by the lock
+        self.__swap_buffer()
+        with self._lock:
+            self.__write_pending()
+            if self._file:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,253 @@
+from array import array
+from bisect import bisect_left
+from itertools import groupby
+from typing import Iterable, Iterator
+import config
+
+__all__ = ["MidBitmap", "make_mid_set"]
+
+# mid is split into (high, low) parts, the low 16 bits are stored in a container
+# indexed by the high part, like roaring bitmap does:
+#   - sparse container: sorted array('H'), 2 bytes per mid
+#   - dense container: bytearray bitmap, 8KB per 65536 mids
+_LOW_BITS = 16
+_LOW_MASK = (1 << _LOW_BITS) - 1
+_BITMAP_BYTES = (1 << _LOW_BITS) // 8
+_ARRAY_MAX_SIZE = 4096  # an array container larger than this costs more than a bitmap
+_ARRAY_MIN_SIZE = _ARRAY_MAX_SIZE // 2  # shrink back to array, avoid converting back and forth
+
+
+class MidBitmap:
+    """
+    A compact set of int, used to replace the builtin set in MidPool.
+    Supports the set operations MidPool relies on: add/discard/pop/update/difference
+    """
+
+    def __init__(self, mids: Iterable[int] = ()):
+        self._chunks = {}  # high -> array('H') | bytearray
+        self._bitmap_sizes = {}  # high -> size of a bitmap container
+        self._size = 0
+        self.update(mids)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __bool__(self) -> bool:
+        return self._size > 0
+
+    def __contains__(self, mid: int) -> bool:
+        chunk = self._chunks.get(mid >> _LOW_BITS)
+        if chunk is None:
+            return False
+        low = mid & _LOW_MASK
+        if type(chunk) is array:
+            i = bisect_left(chunk, low)
+            return i < len(chunk) and chunk[i] == low
+        return bool(chunk[low >> 3] & (1 << (low & 7)))
+
+    def __iter__(self) -> Iterator[int]:
+        # yield mids in ascending order
+        for high in sorted(self._chunks):
+            chunk = self._chunks[high]
+            base = high << _LOW_BITS
+            if type(chunk) is array:
+                for low in chunk:
+                    yield base | low
+            else:
+                yield from self.__iter_bitmap(base, chunk)
+
+    def __repr__(self) -> str:
+        return f"MidBitmap(size={self._size}, chunks={len(self._chunks)})"
+
+    def __sub__(self, other: Iterable[int]) -> "MidBitmap":
+        return self.difference(other)
+
+    def __rsub__(self, other: Iterable[int]):
+        # set(...) - MidBitmap(...), keep the type of left operand
+        return type(other)(mid for mid in other if mid not in self)
+
+    def add(self, mid: int):
+        high = mid >> _LOW_BITS
+        low = mid & _LOW_MASK
+        chunk = self._chunks.get(high)
+        if chunk is None:
+            self._chunks[high] = array("H", (low,))
+            self._size += 1
+        elif type(chunk) is array:
+            i = bisect_left(chunk, low)
+            if i < len(chunk) and chunk[i] == low:
+                return
+            chunk.insert(i, low)
+            self._size += 1
+            if len(chunk) > _ARRAY_MAX_SIZE:
+                self.__to_bitmap(high, chunk)
+        else:
+            bit = 1 << (low & 7)
+            if not chunk[low >> 3] & bit:
+                chunk[low >> 3] |= bit
+                self._size += 1
+                self._bitmap_sizes[high] += 1
+
+    def discard(self, mid: int):
+        high = mid >> _LOW_BITS
+        low = mid & _LOW_MASK
+        chunk = self._chunks.get(high)
+        if chunk is None:
+            return
+        if type(chunk) is array:
+            i = bisect_left(chunk, low)
+            if i < len(chunk) and chunk[i] == low:
+                del chunk[i]
+                self._size -= 1
+                if not chunk:
+                    del self._chunks[high]
+            return
+        bit = 1 << (low & 7)
+        if chunk[low >> 3] & bit:
+            chunk[low >> 3] &= ~bit
+            self._size -= 1
+            self.__shrink_bitmap(high, chunk)
+
+    def remove(self, mid: int):
+        if mid not in self:
+            raise KeyError(mid)
+        self.discard(mid)
+
+    def pop(self) -> int:
+        if not self._chunks:
+            raise KeyError("pop from an empty MidBitmap")
+        # popitem() is O(1), put the container back if it is not empty
+        high, chunk = self._chunks.popitem()
+        if type(chunk) is array:
+            low = chunk.pop()
+            if chunk:
+                self._chunks[high] = chunk
+        else:
+            i = len(chunk.rstrip(b"\x00")) - 1  # the last non-zero byte
+            bit = chunk[i].bit_length() - 1
+            chunk[i] &= ~(1 << bit)
+            low = (i << 3) | bit
+            self._chunks[high] = chunk
+            self.__shrink_bitmap(high, chunk)
+        self._size -= 1
+        return (high << _LOW_BITS) | low
+
+    def update(self, *others: Iterable[int]):
+        for other in others:
+            # MidBitmap is iterated in order, others are sorted to merge container by container
+            mids = other if isinstance(other, MidBitmap) else sorted(other)
+            for high, group in groupby(mids, key=lambda mid: mid >> _LOW_BITS):
+                self.__merge(high, [mid & _LOW_MASK for mid in group])
+
+    def difference(self, *others: Iterable[int]) -> "MidBitmap":
+        result = MidBitmap(self)
+        for other in others:
+            for mid in other:
+                result.discard(mid)
+        return result
+
+    def copy(self) -> "MidBitmap":
+        other = MidBitmap()
+        other._chunks = {high: chunk[:] for high, chunk in self._chunks.items()}
+        other._bitmap_sizes = self._bitmap_sizes.copy()
+        other._size = self._size
+        return other
+
+    def clear(self):
+        self._chunks.clear()
+        self._bitmap_sizes.clear()
+        self._size = 0
+
+    def __merge(self, high: int, lows: list):
+        chunk = self._chunks.get(high)
+        if chunk is None or type(chunk) is array:
+            old_size = len(chunk) if chunk else 0
+            merged = array("H", sorted(set(chunk).union(lows)) if chunk else sorted(set(lows)))
+            self._chunks[high] = merged
+            self._size += len(merged) - old_size
+            if len(merged) > _ARRAY_MAX_SIZE:
+                self.__to_bitmap(high, merged)
+            return
+        added = 0
+        for low in lows:
+            bit = 1 << (low & 7)
+            if not chunk[low >> 3] & bit:
+                chunk[low >> 3] |= bit
+                added += 1
+        self._size += added
+        self._bitmap_sizes[high] += added
+
+    def __to_bitmap(self, high: int, chunk: array):
+        bitmap = bytearray(_BITMAP_BYTES)
+        for low in chunk:
+            bitmap[low >> 3] |= 1 << (low & 7)
+        self._chunks[high] = bitmap
+        self._bitmap_sizes[high] = len(chunk)
+
+    def __shrink_bitmap(self, high: int, chunk: bytearray):
+        self._bitmap_sizes[high] -= 1
+        if self._bitmap_sizes[high] >= _ARRAY_MIN_SIZE:
+            return
+        base = high << _LOW_BITS
+        lows = array("H", (mid - base for mid in self.__iter_bitmap(base, chunk)))
+        del self._bitmap_sizes[high]
+        if lows:
+            self._chunks[high] = lows
+        else:
+            del self._chunks[high]
+
+    @staticmethod
+    def __iter_bitmap(base: int, chunk: bytearray) -> Iterator[int]:
+        for i, byte in enumerate(chunk):
+            if not byte:
+                continue
+            for bit in range(8):
+                if byte >> bit & 1:
+                    yield base | (i << 3) | bit
+
+
+def make_mid_set(mids: Iterable[int] = ()):
+    """Create the mid set for MidPool, the implementation is chosen by config"""
+    set_type = config.MID_POOL.get("set_type")
+    if set_type == "bitmap":
+        return MidBitmap(mids)
+    return set(mids)
+
+
+# ============ for test ===============
+
+
+if __name__ == "__main__":
+    import random
+    import time
+    import tracemalloc
+
+    def measure(factory, mids):
+        tracemalloc.start()
+        start = time.perf_counter()
+        container = factory(mid + 1 for mid in mids)  # new int objects, owned by the container
+        cost = time.perf_counter() - start
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return container, size, cost
+
+    million = 1_000_000
+    cases = {
+        # mid of bilibili is in range [1, ~2^31) for most of the users
+        "sparse": random.sample(range(2 ** 31), million),
+        "dense": random.sample(range(20 * million), million),
+    }
+    for name, mids in cases.items():
+        s, s_bytes, s_cost = measure(set, mids)
+        b, b_bytes, b_cost = measure(MidBitmap, mids)
+        assert len(s) == len(b) == million and sorted(s) == list(b)
+        assert not s - b and not b - s
+        print(f"[{name}] set: {s_bytes / 2**20:.1f} MiB per 1M mids, build {s_cost:.2f}s")
+        print(f"[{name}] MidBitmap: {b_bytes / 2**20:.1f} MiB per 1M mids, build {b_cost:.2f}s")
+
+        start = time.perf_counter()
+        while b:
+            mid = b.pop()
+            s.remove(mid)
+        assert not s
+        print(f"[{name}] MidBitmap pop 1M mids: {time.perf_counter() - start:.2f}s")
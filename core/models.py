@@ -3,7 +3,7 @@ from dataclasses_json import dataclass_json
 from typing import List
 
 
-@dataclass
+@dataclass(slots=True)
 class BaseUserInfo:
     # http://api.bilibili.com/x/space/acc/info?mid=10086
     mid: int
@@ -22,14 +22,14 @@ class BaseUserInfo:
     hard_vip: bool  # 是否硬核会员
 
 
-@dataclass
+@dataclass(slots=True)
 class RelationInfo:
     # http://api.bilibili.com/x/relation/stat?vmid=10086
     following: int  # 关注了多少用户
     follower: int  # 粉丝数
 
 
-@dataclass
+@dataclass(slots=True)
 class ChargeInfo:
     # https://api.bilibili.com/x/ugcpay-rank/elec/month/up?up_mid=10086
     enable: bool  # 是否未开通充电功能
@@ -37,16 +37,16 @@ class ChargeInfo:
     month: int  # 本月充电人数
 
 
-@dataclass
+@dataclass(slots=True)
 class SubmitVideoDetails:
     # http://api.bilibili.com/x/space/arc/search?mid=14110780 (&pn=1&ps=1000)
 
-    @dataclass
+    @dataclass(slots=True)
     class VideoPartitionInfo:
         tid: int  # 分区id
         count: int  # 该分区下投稿的视频数量
 
-    @dataclass
+    @dataclass(slots=True)
     class VideoInfo:
         avid: int  # 稿件 avid
         bvid: str  # 稿件 bvid
@@ -68,7 +68,7 @@ class SubmitVideoDetails:
     videos: List[VideoInfo]  # 投稿视频信息
 
 @dataclass_json
-@dataclass
+@dataclass(slots=True)
 class UpInfo:
     base: BaseUserInfo
     relation: RelationInfo
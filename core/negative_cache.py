@@ -0,0 +1,144 @@
+import asyncio
+import os
+import struct
+import time
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Set, Tuple
+from utils.log import logger
+
+__all__ = ["NegativeCache"]
+
+# record: mid (int64), follower (uint32), checked at (uint32, unix time)
+_RECORD = struct.Struct("<qII")
+
+
+class NegativeCache:
+    """
+    Mids dropped for too few followers, with the follower count and the time checked, kept across runs.
+    A mid is skipped until it's older than `recheck_age`, so known tiny accounts cost no request.
+    Records are appended to a binary file, and kept in sorted arrays (16 bytes per mid)
+    plus a dict of the recent ones, which is merged into the arrays when it's large.
+    """
+
+    def __init__(self, file: str, recheck_age: float, merge_threshold: int):
+        self._file = file
+        self._recheck_age = recheck_age
+        self._merge_threshold = merge_threshold
+        self._mids = array("q")  # sorted
+        self._followers = array("I")
+        self._checked = array("I")
+        self._recent: Dict[int, Tuple[int, int]] = {}  # mid -> (follower, checked at)
+        self._buffer: List[bytes] = []
+        self._loaded = False  # the file may be rewritten while loading, append after loaded
+        self._merging = False
+
+    def __len__(self) -> int:
+        return len(self._mids) + len(self._recent)
+
+    def __read(self) -> Tuple[array, array, array, int]:
+        """Read the file, the later record of a mid wins, the records to recheck are dropped"""
+        latest: Dict[int, Tuple[int, int]] = {}
+        records = 0
+        if os.path.exists(self._file):
+            with open(self._file, "rb") as f:
+                data = f.read()
+            data = data[:len(data) - len(data) % _RECORD.size]  # partially written before a crash
+            for mid, follower, checked in _RECORD.iter_unpack(data):
+                latest[mid] = (follower, checked)
+            records = len(data) // _RECORD.size
+        expire = time.time() - self._recheck_age
+        mids, followers, checked = array("q"), array("I"), array("I")
+        for mid in sorted(latest):
+            follower, checked_at = latest[mid]
+            if checked_at > expire:
+                mids.append(mid)
+                followers.append(follower)
+                checked.append(checked_at)
+        return mids, followers, checked, records
+
+    def __rewrite(self, mids: array, followers: array, checked: array):
+        tmp_file = f"{self._file}.tmp"
+        with open(tmp_file, "wb") as f:
+            for i in range(len(mids)):
+                f.write(_RECORD.pack(mids[i], followers[i], checked[i]))
+        os.replace(tmp_file, self._file)
+
+    async def load(self):
+        start = time.monotonic()
+        mids, followers, checked, records = await asyncio.to_thread(self.__read)
+        if records > 2 * len(mids) + 1024:
+            # too many duplicated or outdated records, and nothing is appended before loaded
+            await asyncio.to_thread(self.__rewrite, mids, followers, checked)
+        self._mids, self._followers, self._checked = mids, followers, checked
+        self._loaded = True
+        logger.info(f"NegativeCache loaded {len(mids)} mid(s) in {time.monotonic() - start:.2f}s")
+
+    def add(self, mid: int, follower: int):
+        checked_at = int(time.time())
+        self._recent[mid] = (follower, checked_at)
+        self._buffer.append(_RECORD.pack(mid, min(follower, 0xFFFFFFFF), checked_at))
+
+    def __checked_at(self, mid: int) -> int:
+        if mid in self._recent:
+            return self._recent[mid][1]
+        i = bisect_left(self._mids, mid)
+        if i < len(self._mids) and self._mids[i] == mid:
+            return self._checked[i]
+        return 0
+
+    def filter(self, mids: Iterable[int]) -> Set[int]:
+        """The mids not known as tiny accounts, or due for recheck"""
+        expire = time.time() - self._recheck_age
+        return {mid for mid in mids if self.__checked_at(mid) <= expire}
+
+    def __merge(self, recent: Dict[int, Tuple[int, int]]) -> Tuple[array, array, array]:
+        mids, followers, checked = array("q"), array("I"), array("I")
+        old = self._mids
+        i = 0
+        for mid in sorted(recent):
+            # copy the older ones by slices, a merge costs O(k log n) plus a memory copy
+            j = bisect_left(old, mid, i)
+            mids.extend(old[i:j])
+            followers.extend(self._followers[i:j])
+            checked.extend(self._checked[i:j])
+            i = j
+            if i < len(old) and old[i] == mid:
+                i += 1  # rechecked, replaced by the recent one
+            follower, checked_at = recent[mid]
+            mids.append(mid)
+            followers.append(min(follower, 0xFFFFFFFF))
+            checked.append(checked_at)
+        mids.extend(old[i:])
+        followers.extend(self._followers[i:])
+        checked.extend(self._checked[i:])
+        return mids, followers, checked
+
+    def __append(self, data: bytes):
+        with open(self._file, "ab") as f:
+            f.write(data)
+
+    async def flush(self):
+        if not self._loaded:
+            return
+        if self._buffer:
+            data = b"".join(self._buffer)
+            self._buffer.clear()
+            await asyncio.to_thread(self.__append, data)
+        if len(self._recent) >= self._merge_threshold and not self._merging:
+            self._merging = True
+            recent = self._recent.copy()
+            try:
+                merged = await asyncio.to_thread(self.__merge, recent)
+                self._mids, self._followers, self._checked = merged
+                # mids added again while merging are kept in recent
+                for mid, value in recent.items():
+                    if self._recent.get(mid) == value:
+                        del self._recent[mid]
+            finally:
+                self._merging = False
+
+    def close(self):
+        if self._buffer:
+            self.__append(b"".join(self._buffer))
+            self._buffer.clear()
@@ -1,11 +1,18 @@
+import heapq
+import json
+import math
 import random
+import time
 from datetime import datetime, timedelta
 import asyncio
 from aiohttp import ClientSession, AsyncResolver, TCPConnector
 
 import config
 from utils.log import logger
-from typing import List
+from bisect import bisect_left, insort
+from typing import Dict, List, Tuple
+
+_EWMA_ALPHA = 0.2  # weight of the latest sample in the rolling stats
 
 
 class Proxy:
@@ -13,49 +20,206 @@ class Proxy:
     def __init__(self, ip: str, port: int, expire_time: datetime):
         self._ip = ip
         self._port = port
-        self._expire_time = expire_time
+        # timestamps are compared on every request, float is much cheaper than datetime
+        self._expire_time = expire_time.timestamp()
         self._ban_times = 0
-        self._reuse_time = datetime.now()
+        self._reuse_time = 0.0
         self._valid_flag = True
         self._ban_strategy = {
             1: 30, # seconds
             2: 60,
             3: 120
         }
+        self._pool = None  # the pool is notified when the proxy is banned or invalid
+        # rolling health stats
+        self._latency = 1.0  # EWMA of response time, seconds
+        self._success_ratio = 1.0  # EWMA
+        self._ban_ratio = 0.0  # EWMA of 412 responses
+        self._requests = 0
+        self._bytes = 0
 
     def get_proxy(self) -> str:
         return f"http://{self._ip}:{self._port}"
 
+    def record(self, latency: float, success: bool, banned: bool = False, nbytes: int = 0):
+        """Record the result of a request sent by this proxy"""
+        alpha = _EWMA_ALPHA
+        self._latency += alpha * (latency - self._latency)
+        self._success_ratio += alpha * (success - self._success_ratio)
+        self._ban_ratio += alpha * (banned - self._ban_ratio)
+        self._requests += 1
+        self._bytes += nbytes
+        if self._pool:
+            self._pool.on_proxy_result(latency, success, banned, nbytes)
+
+    def score(self) -> float:
+        """Higher is better: successful, not banned and fast"""
+        return self._success_ratio * (1 - self._ban_ratio) / max(self._latency, 0.01)
+
+    def stats(self) -> dict:
+        return {
+            "proxy": self.get_proxy(),
+            "score": round(self.score(), 4),
+            "latency": round(self._latency, 4),
+            "success_ratio": round(self._success_ratio, 4),
+            "ban_ratio": round(self._ban_ratio, 4),
+            "requests": self._requests,
+            "bytes": self._bytes
+        }
+
     def is_available(self) -> bool:
-        return self.is_valid() and datetime.now() > self._reuse_time
+        return self.is_valid() and time.time() > self._reuse_time
 
     def is_valid(self) -> bool:
-        return self._valid_flag and datetime.now() < self._expire_time
+        return self._valid_flag and time.time() < self._expire_time
 
     def mark_as_invalid(self, reason: str = ""):
         self._valid_flag = False
         logger.debug(f"Proxy {self.get_proxy()} is marked as invalid: {reason}")
-
-    def rate_limit(self):
-        self._reuse_time = datetime.now() + timedelta(milliseconds=10)
+        if self._pool:
+            self._pool.on_proxy_invalid(self)
 
     def add_ban_times(self):
         self._ban_times += 1
         wait_time = self._ban_strategy.get(self._ban_times, 60)
-        self._reuse_time = datetime.now() + timedelta(seconds=wait_time)
+        self._reuse_time = time.time() + wait_time
         logger.debug(
-            f"Proxy {self.get_proxy()} is ban, it will reuse at {self._reuse_time}")
+            f"Proxy {self.get_proxy()} is ban, it will reuse at {datetime.fromtimestamp(self._reuse_time)}")
+        if self._pool:
+            self._pool.on_proxy_banned(self)
 
 
 class ProxyPool:
+    """
+    Proxies are indexed by state:
+      - ready: a list with index, random choice and removal are O(1)
+      - banned: a min-heap by reuse time, moved back to ready when it's due
+    Invalid proxies are dropped when they are found, expired ones are pruned by
+    a list sorted by expire time. The pool is refilled by the measured demand.
+    """
 
     def __init__(self):
-        self._lock = None
-        self._cond = None
-        self._proxies: List[Proxy] = []
+        self._ready: List[Proxy] = []
+        self._ready_index: Dict[Proxy, int] = {}
+        self._banned: List[Tuple[float, int, Proxy]] = []  # (reuse time, seq, proxy)
+        self._banned_seq = 0
+        self._ready_event = asyncio.Event()  # set when there are ready proxies
         self._session = None
         self._bg_update_proxy_task = None
         self._sources_type = config.PROXY_POOL["type"]
+        self._stats_file = config.PROXY_POOL["stats_file"]
+        self._stats_dump_interval = config.PROXY_POOL["stats_dump_interval"]
+        self._bg_dump_stats_task = None
+        # totals of all the proxies, including the dropped ones
+        self._total_stats = {"requests": 0, "success": 0, "banned": 0, "bytes": 0, "latency": 0.0}
+        # demand driven refill
+        self._expiry: List[Tuple[float, int, Proxy]] = []  # sorted by expire time
+        self._expiry_seq = 0
+        self._refill_config = config.PROXY_POOL["refill"]
+        self._demand_event = asyncio.Event()  # set when proxies are running out
+        self._waiters = 0
+        self._lost = 0  # proxies banned/invalid since the last refill, expired ones are prefetched
+        self._banned_count = 0  # proxies banned since the last refill
+        self._loss_rate = 0.0  # EWMA, proxies lost per second
+        self._ban_rate = 0.0  # EWMA, proxies banned per second
+        self._last_refill = time.monotonic()
+
+    def __add_ready(self, proxy: Proxy):
+        if proxy in self._ready_index:
+            return
+        self._ready_index[proxy] = len(self._ready)
+        self._ready.append(proxy)
+        self._ready_event.set()
+
+    def __remove_ready(self, proxy: Proxy):
+        i = self._ready_index.pop(proxy, None)
+        if i is None:
+            return
+        # move the last one to the hole
+        last = self._ready.pop()
+        if last is not proxy:
+            self._ready[i] = last
+            self._ready_index[last] = i
+        if not self._ready:
+            self._ready_event.clear()
+        if len(self._ready) < self._refill_config["min_ready"]:
+            self._demand_event.set()
+
+    def __add_proxies(self, proxies: List[Proxy]):
+        for proxy in proxies:
+            proxy._pool = self
+            self.__add_ready(proxy)
+            self._expiry_seq += 1
+            insort(self._expiry, (proxy._expire_time, self._expiry_seq, proxy))
+
+    def __prune_expired(self):
+        now = time.time()
+        expired = bisect_left(self._expiry, (now,))
+        if expired == 0:
+            return
+        for _, _, proxy in self._expiry[:expired]:
+            self.__remove_ready(proxy)
+        del self._expiry[:expired]
+        logger.debug(f"ProxyPool prune {expired} expired proxies")
+
+    def __expiring_ready_nums(self, seconds: float) -> int:
+        # the ready proxies which will expire soon, they should be replaced in advance
+        end = bisect_left(self._expiry, (time.time() + seconds,))
+        return sum(1 for _, _, proxy in self._expiry[:end] if proxy in self._ready_index)
+
+    def __release_banned(self):
+        now = time.time()
+        while self._banned and self._banned[0][0] <= now:
+            _, _, proxy = heapq.heappop(self._banned)
+            # banned again after pushed, a newer entry is in the heap
+            if proxy._reuse_time <= now and proxy.is_valid():
+                self.__add_ready(proxy)
+
+    def on_proxy_banned(self, proxy: Proxy):
+        if proxy in self._ready_index:
+            self._banned_count += 1
+            self._lost += 1
+        self.__remove_ready(proxy)
+        self._banned_seq += 1
+        heapq.heappush(self._banned, (proxy._reuse_time, self._banned_seq, proxy))
+
+    def on_proxy_invalid(self, proxy: Proxy):
+        if proxy in self._ready_index:
+            self._lost += 1
+        self.__remove_ready(proxy)  # removed from the banned heap when it's due
+
+    def on_proxy_result(self, latency: float, success: bool, banned: bool, nbytes: int):
+        stats = self._total_stats
+        stats["requests"] += 1
+        stats["success"] += success
+        stats["banned"] += banned
+        stats["bytes"] += nbytes
+        stats["latency"] += latency
+
+    def __dump_stats(self):
+        requests = self._total_stats["requests"]
+        proxies = self._ready + [proxy for _, _, proxy in self._banned if proxy.is_valid()]
+        data = {
+            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "source": self._sources_type,
+            "total": {
+                "proxies": len(proxies),
+                "requests": requests,
+                "bytes": self._total_stats["bytes"],
+                "success_ratio": self._total_stats["success"] / requests if requests else 0,
+                "ban_ratio": self._total_stats["banned"] / requests if requests else 0,
+                "avg_latency": self._total_stats["latency"] / requests if requests else 0
+            },
+            "proxies": sorted((proxy.stats() for proxy in set(proxies)), key=lambda s: s["score"], reverse=True)
+        }
+        with open(self._stats_file, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+        logger.info(f"Dump ProxyPool stats to file: {self._stats_file}")
+
+    async def __dump_stats_task(self):
+        while True:
+            await asyncio.sleep(self._stats_dump_interval)
+            self.__dump_stats()
 
     async def __load_from_file(self):
         proxies = []
@@ -63,18 +227,13 @@ class ProxyPool:
         with open(path, "r") as f:
             for host in f:
                 ip, port = host.split(":")
-                proxy = Proxy(ip, int(port), "2099-01-01 00:00:00")
+                proxy = Proxy(ip, int(port), datetime(2099, 1, 1))
                 proxies.append(proxy)
             logger.info(f"Load {len(proxies)} from file {path}")
 
-        async with self._cond:
-            self._proxies = proxies
-            self._cond.notify_all()
+        self.__add_proxies(proxies)
 
     async def __init(self):
-        self._lock = asyncio.Lock()  # lock in current loop
-        self._cond = asyncio.Condition(self._lock)
-
         con = TCPConnector(ttl_dns_cache=300, resolver=AsyncResolver())
         self._session = ClientSession(connector=con)
 
@@ -112,63 +271,75 @@ class ProxyPool:
                 proxies.append(Proxy(ip, int(port), expire_time))
             return proxies
 
-    async def __available_proxies_nums(self) -> int:
-        async with self._lock:
-            count = 0
-            for proxy in self._proxies:
-                if proxy.is_available():
-                    count += 1
-            logger.info(f"Available proxies num: {count}")
-            return count
-
-    async def __update_proxies(self):
-        pool_size = 1
-        if self._sources_type == "zhima":
-            pool_size = config.PROXY_POOL["zhima"]["pool_size"]
-        elif self._sources_type == "juliang":
-            pool_size = config.PROXY_POOL["juliang"]["pool_size"]
-
-        if await self.__available_proxies_nums() >= pool_size:
-            return
-
-        for _ in range(3):
+    async def __fetch_new_proxies(self) -> List[Proxy]:
+        try:
             if self._sources_type == "zhima":
-                proxies = await self.__zhima_fetch_new_proxies()
+                return await self.__zhima_fetch_new_proxies()
             elif self._sources_type == "juliang":
-                proxies = await self.__juliang_fetch_new_proxies()
-
-            if len(proxies) == 0:
-                continue
-
-            async with self._cond:
-                self._proxies.extend(proxies)
-                logger.info(
-                    f"ProxyPool add {len(proxies)} proxy, total: {len(self._proxies)}")
-                self._cond.notify_all()
-            break
-
-    async def __check_proxies(self):
-        valid_proxies = []
-        drop_count = 0
-        async with self._lock:
-            for proxy in self._proxies:
-                if proxy.is_valid():
-                    valid_proxies.append(proxy)
-                else:
-                    drop_count += 1
-            if drop_count > 0:
-                self._proxies = valid_proxies
-                logger.info(
-                    f"ProxyPool remove {drop_count} invalid proxies")
+                return await self.__juliang_fetch_new_proxies()
+        except Exception as e:
+            logger.warning(f"ProxyPool fetch new proxies failed: {e!r}")
+        return []
+
+    def __measure_demand(self) -> int:
+        """Update the loss rate, return how many ready proxies we need"""
+        now = time.monotonic()
+        elapsed = max(now - self._last_refill, 1e-3)
+        alpha = min(1.0, elapsed / self._refill_config["horizon"])
+        self._loss_rate += alpha * (self._lost / elapsed - self._loss_rate)
+        self._ban_rate += alpha * (self._banned_count / elapsed - self._ban_rate)
+        self._lost = 0
+        self._banned_count = 0
+        self._last_refill = now
+
+        pool_size = config.PROXY_POOL[self._sources_type]["pool_size"]
+        # enough proxies to cover the loss in the next horizon, more when workers are starving.
+        # expired proxies are not counted as loss, they are replaced before expiring
+        target = self._refill_config["min_ready"] + self._loss_rate * self._refill_config["horizon"]
+        if self._waiters > 0:
+            target += self._refill_config["batch"] * self._refill_config["max_concurrent_fetch"]
+        return min(pool_size, math.ceil(target))
+
+    async def __refill(self):
+        target = self.__measure_demand()
+        self.__release_banned()
+        available = len(self._ready) - self.__expiring_ready_nums(self._refill_config["prefetch"])
+        if available >= target:
+            return
+
+        # one call of vendor api returns a batch of proxies, call them concurrently
+        calls = min(math.ceil((target - available) / self._refill_config["batch"]),
+                    self._refill_config["max_concurrent_fetch"])
+        results = await asyncio.gather(*(self.__fetch_new_proxies() for _ in range(calls)))
+        proxies = [proxy for result in results for proxy in result]
+        self.__add_proxies(proxies)
+        logger.info(f"ProxyPool add {len(proxies)} proxy by {calls} call(s), {target=}, "
+                    f"ready: {len(self._ready)}, banned: {len(self._banned)}, "
+                    f"loss rate: {self._loss_rate:.2f}/s, ban rate: {self._ban_rate:.2f}/s")
 
     async def get_random_proxy(self) -> Proxy:
-        async with self._cond:
-            while True:
-                available_proxies = [
-                    p for p in self._proxies if p.is_available()]
-                if len(available_proxies) > 0:
-                    return random.choice(available_proxies)
-                await self._cond.wait()
+        while True:
+            self.__release_banned()
+            while self._ready:
+                # power of two choices: the better of 2 random proxies,
+                # healthy proxies get more traffic, but the others still get some to update their stats
+                proxy = random.choice(self._ready)
+                other = random.choice(self._ready)
+                if other.score() > proxy.score():
+                    proxy, other = other, proxy
+                if proxy.is_valid():
+                    return proxy
+                self.__remove_ready(proxy)  # expired
+            # wait until new proxies are added, or the first banned proxy can be reused
+            timeout = max(0.0, self._banned[0][0] - time.time()) if self._banned else None
+            self._waiters += 1
+            self._demand_event.set()
+            try:
+                await asyncio.wait_for(self._ready_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._waiters -= 1
 
     async def __run(self) -> None:
         if self._sources_type == "file":
@@ -178,17 +349,30 @@ class ProxyPool:
         logger.info("Update proxy task running...")
         await self.__init()
         while True:
-            await self.__update_proxies()
-            await self.__check_proxies()
-            await asyncio.sleep(1.1)
+            self.__prune_expired()
+            await self.__refill()
+            # wake up when proxies are running out, or the next proxy expires
+            timeout = self._refill_config["interval"]
+            if self._expiry:
+                next_expiry = self._expiry[0][0] - self._refill_config["prefetch"] - time.time()
+                timeout = min(timeout, max(0.1, next_expiry))
+            try:
+                await asyncio.wait_for(self._demand_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._demand_event.clear()
 
     def start_update_proxy_task(self):
         self._bg_update_proxy_task = asyncio.create_task(self.__run())
+        self._bg_dump_stats_task = asyncio.create_task(self.__dump_stats_task())
 
     def stop(self):
         if not self._bg_update_proxy_task.cancelled():
             self._bg_update_proxy_task.cancel()
             logger.info("Update proxy task stopped")
+        if not self._bg_dump_stats_task.cancelled():
+            self._bg_dump_stats_task.cancel()
+            self.__dump_stats()
 
 # =========== for test =============
 
@@ -0,0 +1,141 @@
+import asyncio
+import time
+from typing import Dict, Hashable
+from utils.log import logger
+
+__all__ = ["AimdRateLimiter"]
+
+
+class TokenBucket:
+    """
+    Token bucket in the form of GCRA: every acquire reserves the next free slot,
+    so waiters sleep until their own slot instead of waking up together to compete.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self._burst = burst
+        self._tat = time.monotonic()  # theoretical arrival time of the next request
+
+    async def acquire(self):
+        now = time.monotonic()
+        interval = 1 / self.rate
+        tat = max(self._tat, now)
+        self._tat = tat + interval
+        delay = tat - now - (self._burst - 1) * interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class _EndpointState:
+
+    def __init__(self, rate: float, burst: int):
+        self.bucket = TokenBucket(rate, burst)
+        self.requests = 0
+        self.bans = 0  # 412 responses
+        self.throttles = 0  # times of decreasing rate
+        self.last_decrease = 0.0
+        self.last_used = time.monotonic()
+        # responses of the current window, the rate is decreased by the ratio of 412 in it
+        self.window_start = self.last_used
+        self.window_responses = 0
+        self.window_bans = 0
+
+
+class AimdRateLimiter:
+    """
+    Rate limiters keyed by endpoint (and proxy), the rate is adjusted by AIMD:
+    increase additively on success, decrease multiplicatively when the ratio of 412 in a window
+    is above the threshold, so a few random 412s don't throttle, but being banned does.
+    The limiters not used for `idle_timeout` (like the ones of expired proxies) are evicted.
+    """
+
+    def __init__(self, initial_rate: float, min_rate: float, max_rate: float, burst: int,
+                 increase_step: float, decrease_factor: float, decrease_cooldown: float,
+                 ban_window: float, ban_threshold: float, ban_min_samples: int, idle_timeout: float):
+        self._initial_rate = initial_rate
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._burst = burst
+        self._increase_step = increase_step  # about `increase_step` req/s more per second
+        self._decrease_factor = decrease_factor
+        self._decrease_cooldown = decrease_cooldown  # 412s of requests sent before decreasing are ignored
+        self._ban_window = ban_window  # seconds
+        self._ban_threshold = ban_threshold  # ratio of 412 in a window to decrease the rate
+        self._ban_min_samples = ban_min_samples  # responses in a window before the ratio is trusted
+        self._idle_timeout = idle_timeout
+        self._last_evict = time.monotonic()
+        self._states: Dict[Hashable, _EndpointState] = {}
+
+    def __state(self, key: Hashable) -> _EndpointState:
+        now = time.monotonic()
+        if now - self._last_evict >= self._idle_timeout:
+            self.__evict(now)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _EndpointState(self._initial_rate, self._burst)
+        state.last_used = now
+        return state
+
+    def __evict(self, now: float):
+        self._last_evict = now
+        idle = [key for key, state in self._states.items() if now - state.last_used >= self._idle_timeout]
+        for key in idle:
+            del self._states[key]
+        if idle:
+            logger.debug(f"Evict {len(idle)} idle rate limiter(s)")
+
+    def __record(self, state: _EndpointState, banned: bool):
+        now = time.monotonic()
+        if now - state.window_start >= self._ban_window:
+            state.window_start = now
+            state.window_responses = 0
+            state.window_bans = 0
+        state.window_responses += 1
+        state.window_bans += banned
+
+    async def acquire(self, key: Hashable):
+        state = self.__state(key)
+        state.requests += 1
+        await state.bucket.acquire()
+
+    def on_success(self, key: Hashable):
+        state = self.__state(key)
+        self.__record(state, banned=False)
+        bucket = state.bucket
+        # increase by step/rate per response, that's about `step` per second
+        bucket.rate = min(self._max_rate, bucket.rate + self._increase_step / bucket.rate)
+
+    def on_ban(self, key: Hashable):
+        state = self.__state(key)
+        state.bans += 1
+        self.__record(state, banned=True)
+        if state.window_responses < self._ban_min_samples \
+                or state.window_bans <= self._ban_threshold * state.window_responses:
+            return  # random 412s, not banned for the rate
+        now = time.monotonic()
+        if now - state.last_decrease < self._decrease_cooldown:
+            return
+        state.last_decrease = now
+        # the responses before decreasing don't count for the new rate
+        state.window_start = now
+        state.window_responses = 0
+        state.window_bans = 0
+        state.throttles += 1
+        state.bucket.rate = max(self._min_rate, state.bucket.rate * self._decrease_factor)
+        logger.debug(f"Throttle {key}, rate={state.bucket.rate:.2f}/s")
+
+    def stats(self) -> Dict[Hashable, dict]:
+        return {
+            key: {
+                "rate": state.bucket.rate,
+                "requests": state.requests,
+                "bans": state.bans,
+                "throttles": state.throttles
+            } for key, state in self._states.items()
+        }
+
+    def report(self):
+        for key, stat in self.stats().items():
+            logger.info(f"RateLimiter {key}: rate={stat['rate']:.2f}/s, requests={stat['requests']}, "
+                        f"bans={stat['bans']}, throttles={stat['throttles']}")
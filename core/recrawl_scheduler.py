@@ -0,0 +1,207 @@
+import asyncio
+import heapq
+import json
+import math
+import os
+import random
+import struct
+import time
+from array import array
+from typing import Dict, List, Tuple
+from utils.log import logger
+
+try:
+    import orjson  # optional, faster to decode
+except ImportError:
+    orjson = None
+
+__all__ = ["RecrawlScheduler"]
+
+# state file: magic, header (data files, ups), the data files with the offset scanned,
+# then the columns of ups one by one
+_MAGIC = b"RECRAWL\x02"
+_HEADER = struct.Struct("<qq")
+_DATA_FILE = struct.Struct("<qI")  # offset, length of the utf-8 path
+
+
+class RecrawlScheduler:
+    """
+    Decide when to crawl the saved ups again. Every up has its own refresh interval:
+    halved when it changed since the last crawl (new videos, or followers changed enough),
+    grown when it didn't, so active ups are refreshed often and the dead ones rarely.
+    Due ups are handed out within a budget of requests per hour, weighted by the pages an up costs.
+    """
+
+    def __init__(self, state_file: str, base_interval: float, min_interval: float, max_interval: float,
+                 follower_change: float, increase_factor: float, decrease_factor: float,
+                 retry_delay: float, requests_per_hour: float, save_interval: float):
+        self._state_file = state_file
+        self._base_interval = base_interval
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._follower_change = follower_change  # relative change of followers considered as changed
+        self._increase_factor = increase_factor
+        self._decrease_factor = decrease_factor
+        self._retry_delay = retry_delay
+        self._rate = requests_per_hour / 3600
+        self.save_interval = save_interval
+        self._tat = 0.0  # the time the budget allows the next up
+        self._data_offsets: Dict[str, int] = {}  # data file -> the saved UpInfo records are scanned up to here
+        # columns of the ups, indexed by slot
+        self._slots: Dict[int, int] = {}  # mid -> slot
+        self._mids = array("q")
+        self._followers = array("q")
+        self._videos = array("I")
+        self._crawled = array("d")
+        self._due = array("d")
+        self._intervals = array("f")
+        self._heap: List[Tuple[float, int]] = []  # (due, slot), outdated entries are skipped
+        self._recrawled = 0
+        self._changed = 0
+
+    def __len__(self) -> int:
+        return len(self._mids)
+
+    def __add(self, mid: int, follower: int, videos: int, crawled: float, due: float, interval: float):
+        slot = self._slots.get(mid)
+        if slot is None:
+            slot = self._slots[mid] = len(self._mids)
+            for column in self.__columns():
+                column.append(0)
+            self._mids[slot] = mid
+        self._followers[slot] = follower
+        self._videos[slot] = videos
+        self._crawled[slot] = crawled
+        self._due[slot] = due
+        self._intervals[slot] = interval
+
+    def __columns(self) -> Tuple[array, ...]:
+        return self._mids, self._followers, self._videos, self._crawled, self._due, self._intervals
+
+    def __load_state(self):
+        with open(self._state_file, "rb") as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError(f"Not a RecrawlScheduler state: {self._state_file}")
+            files, count = _HEADER.unpack(f.read(_HEADER.size))
+            for _ in range(files):
+                offset, length = _DATA_FILE.unpack(f.read(_DATA_FILE.size))
+                self._data_offsets[f.read(length).decode("utf-8")] = offset
+            for column in self.__columns():
+                column.frombytes(f.read(count * column.itemsize))
+        self._slots = {mid: slot for slot, mid in enumerate(self._mids)}
+
+    def __scan_data_file(self, data_file: str) -> int:
+        """Add the ups saved after the last scan, they are due in about the base interval"""
+        crawled = os.path.getmtime(data_file)  # the records have no time, the file time is close enough
+        loads = orjson.loads if orjson else json.loads
+        added = 0
+        offset = self._data_offsets.get(data_file, 0)
+        with open(data_file, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # being written
+                offset += len(line)
+                info = loads(line)
+                mid = info["base"]["mid"]
+                if mid in self._slots:
+                    continue
+                # spread the first refresh, or all of them are due at the same time
+                due = crawled + self._base_interval * random.uniform(0.5, 1.5)
+                self.__add(mid, info["relation"]["follower"], info["video"]["total_videos"],
+                           crawled, due, self._base_interval)
+                added += 1
+        self._data_offsets[data_file] = offset
+        return added
+
+    async def load(self, data_files: List[str]):
+        """Load the state and scan the json lines files of saved ups, the first one is the main output"""
+        start = time.monotonic()
+        if os.path.exists(self._state_file):
+            await asyncio.to_thread(self.__load_state)
+        added = 0
+        for data_file in data_files:
+            if os.path.exists(data_file):
+                added += await asyncio.to_thread(self.__scan_data_file, data_file)
+        if not self:
+            logger.warning(f"RecrawlScheduler found no saved up in {data_files}")
+        self._heap = [(due, slot) for slot, due in enumerate(self._due)]
+        heapq.heapify(self._heap)
+        logger.info(f"RecrawlScheduler loaded {len(self)} up(s), {added} new from {len(data_files)} file(s), "
+                    f"cost {time.monotonic() - start:.2f}s")
+
+    def __dump_state(self, header: bytes, columns: List[array]):
+        tmp_file = f"{self._state_file}.tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(header)
+            for column in columns:
+                column.tofile(f)
+        os.replace(tmp_file, self._state_file)
+
+    async def save(self):
+        # copying is much faster than writing, write the copies in a thread
+        header = [_MAGIC, _HEADER.pack(len(self._data_offsets), len(self))]
+        for data_file, offset in self._data_offsets.items():
+            path = data_file.encode("utf-8")
+            header.append(_DATA_FILE.pack(offset, len(path)))
+            header.append(path)
+        header = b"".join(header)
+        columns = [array(column.typecode, column) for column in self.__columns()]
+        await asyncio.to_thread(self.__dump_state, header, columns)
+        logger.info(f"RecrawlScheduler saved {len(self)} up(s) to {self._state_file}")
+
+    def __cost(self, slot: int) -> int:
+        # relation, info, charge and the video pages
+        return 3 + max(1, math.ceil(self._videos[slot] / 50))
+
+    async def get_due_mid(self) -> int:
+        """Wait until an up is due and the budget allows it"""
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] != self._due[self._heap[0][1]]:
+                heapq.heappop(self._heap)  # rescheduled, outdated entry
+            if not self._heap or self._heap[0][0] > now:
+                wait = self._heap[0][0] - now if self._heap else 60
+                await asyncio.sleep(min(wait, 60))  # new ups may be scheduled earlier
+                continue
+            _, slot = heapq.heappop(self._heap)
+            # reserve the budget of this up, like a token bucket weighted by cost
+            start = max(self._tat, time.monotonic())
+            self._tat = start + self.__cost(slot) / self._rate
+            if start > time.monotonic():
+                await asyncio.sleep(start - time.monotonic())
+            return self._mids[slot]
+
+    def __reschedule(self, slot: int, due: float):
+        self._due[slot] = due
+        heapq.heappush(self._heap, (due, slot))
+
+    def update(self, mid: int, follower: int, videos: int):
+        """The up is crawled again, adjust its interval by what changed"""
+        slot = self._slots[mid]
+        old_follower = self._followers[slot]
+        changed = videos != self._videos[slot] \
+            or abs(follower - old_follower) >= self._follower_change * max(old_follower, 1)
+        interval = self._intervals[slot]
+        if changed:
+            interval = max(self._min_interval, interval * self._decrease_factor)
+            self._changed += 1
+        else:
+            interval = min(self._max_interval, interval * self._increase_factor)
+        now = time.time()
+        self._followers[slot] = follower
+        self._videos[slot] = videos
+        self._crawled[slot] = now
+        self._intervals[slot] = interval
+        self.__reschedule(slot, now + interval)
+        self._recrawled += 1
+
+    def failed(self, mid: int):
+        slot = self._slots[mid]
+        self.__reschedule(slot, time.time() + self._retry_delay)
+
+    def report(self):
+        now = time.time()
+        due = sum(1 for d in self._due if d <= now)
+        logger.info(f"RecrawlScheduler: {len(self)} up(s), {due} due, {self._recrawled} recrawled, "
+                    f"{self._changed} changed")
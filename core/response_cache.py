@@ -0,0 +1,198 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urlparse
+from utils.log import logger
+
+__all__ = ["ResponseCache"]
+
+
+class ResponseCache:
+    """
+    Cache of api responses, keyed by url and params, with ttl per endpoint.
+    Records are appended to a log file: "<expire time> <key>\\t<json data>\\n",
+    the index (key -> position in the file) is in memory and evicts the least recently used.
+    The file is compacted when the evicted and outdated records take more space than the live ones.
+    """
+
+    def __init__(self, path: str, ttl: Dict[str, float], max_entries: int, max_bytes: int):
+        self._path = path
+        self._ttl = ttl  # endpoint path -> seconds, endpoints not in it are not cached
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._index: OrderedDict[str, Tuple[int, int, float]] = OrderedDict()  # key -> (offset, length, expire)
+        self._live_bytes = 0
+        self._file = None
+        self._size = 0  # file size, including the buffered records
+        self._flushed_size = 0
+        self._reader = None  # for reading, seek + read works on every platform, os.pread doesn't on Windows
+        self._bg_compact_task = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def __key(url: str, params: Optional[dict]) -> str:
+        if not params:
+            return url
+        return f"{url}?{urlencode(sorted(params.items()))}"
+
+    async def open(self):
+        # the file can be as large as max_bytes, don't block the event loop
+        if os.path.exists(self._path):
+            await asyncio.to_thread(self.__load)
+        self._file = open(self._path, "ab")
+        self._size = self._flushed_size = self._file.tell()
+        self._reader = open(self._path, "rb")
+        logger.info(f"ResponseCache loaded {len(self._index)} record(s) from {self._path}")
+
+    def __load(self):
+        now = time.time()
+        offset = 0
+        broken = False
+        with open(self._path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    broken = True  # the last record may be partially written before a crash
+                    break
+                expire, _, rest = line.partition(b" ")
+                key = rest.partition(b"\t")[0].decode("utf-8")
+                self.__index_remove(key)
+                if float(expire) > now:
+                    self.__index_add(key, offset, len(line), float(expire))
+                offset += len(line)
+        if broken:
+            logger.warning(f"Truncate broken ResponseCache record at {offset}")
+            os.truncate(self._path, offset)
+        self.__evict()
+
+    def __index_add(self, key: str, offset: int, length: int, expire: float):
+        self._index[key] = (offset, length, expire)
+        self._live_bytes += length
+
+    def __index_remove(self, key: str):
+        entry = self._index.pop(key, None)
+        if entry:
+            self._live_bytes -= entry[1]
+
+    def __evict(self):
+        while len(self._index) > self._max_entries or self._live_bytes > self._max_bytes:
+            _, (_, length, _) = self._index.popitem(last=False)
+            self._live_bytes -= length
+
+    def __read(self, offset: int, length: int) -> bytes:
+        if offset + length > self._flushed_size:
+            self.__flush_buffer()  # never compact here, the offset would be outdated
+        self._reader.seek(offset)
+        return self._reader.read(length)
+
+    def get(self, url: str, params: Optional[dict]) -> Optional[dict]:
+        if urlparse(url).path not in self._ttl:
+            return None
+        key = self.__key(url, params)
+        entry = self._index.get(key)
+        if entry is None or entry[2] <= time.time():
+            self.__index_remove(key)
+            self.misses += 1
+            return None
+        self._index.move_to_end(key)
+        self.hits += 1
+        line = self.__read(entry[0], entry[1])
+        return json.loads(line.partition(b"\t")[2])
+
+    def put(self, url: str, params: Optional[dict], data: dict):
+        ttl = self._ttl.get(urlparse(url).path)
+        if ttl is None:
+            return
+        key = self.__key(url, params)
+        expire = time.time() + ttl
+        line = f"{expire:.0f} {key}\t{json.dumps(data, ensure_ascii=False)}\n".encode("utf-8")
+        self._file.write(line)
+        self.__index_remove(key)
+        self.__index_add(key, self._size, len(line), expire)
+        self._size += len(line)
+        self.__evict()
+        if self._size - self._flushed_size >= 1024 * 1024:
+            self.__flush_buffer()
+        if self.__need_compact() and not self._bg_compact_task:
+            self._bg_compact_task = asyncio.create_task(self.__compact())
+            self._bg_compact_task.set_name("ResponseCacheCompactTask")
+
+    def __flush_buffer(self):
+        if self._file and self._size > self._flushed_size:
+            self._file.flush()
+            self._flushed_size = self._size
+
+    def __need_compact(self) -> bool:
+        # evicted and outdated records take more than half of the file
+        return self._size > 64 * 1024 * 1024 and self._size > 2 * self._live_bytes
+
+    def __copy_records(self, tmp_path: str, records: List[Tuple[int, int]]):
+        with open(self._path, "rb") as src, open(tmp_path, "wb") as dst:
+            for offset, length in records:
+                src.seek(offset)
+                dst.write(src.read(length))
+
+    async def __compact(self):
+        """
+        Copy the live records to a new file in a thread, get/put go on with the old file meanwhile.
+        The records appended during the copy are moved over at the end, then the index is remapped.
+        """
+        try:
+            start = time.perf_counter()
+            tmp_path = f"{self._path}.tmp"
+            self.__flush_buffer()
+            copied_size = self._flushed_size
+            offsets: Dict[int, int] = {}  # old offset -> new offset
+            records = []
+            offset = 0
+            for old_offset, length, _ in self._index.values():  # keep the LRU order
+                offsets[old_offset] = offset
+                records.append((old_offset, length))
+                offset += length
+            await asyncio.to_thread(self.__copy_records, tmp_path, records)
+
+            # the records appended meanwhile, it's a small tail of the file
+            self.__flush_buffer()
+            tail_offset = offset
+            with open(tmp_path, "ab") as dst:
+                self._reader.seek(copied_size)
+                dst.write(self._reader.read(self._size - copied_size))
+            index = OrderedDict()
+            for key, (old_offset, length, expire) in self._index.items():
+                if old_offset >= copied_size:
+                    index[key] = (tail_offset + old_offset - copied_size, length, expire)
+                else:
+                    index[key] = (offsets[old_offset], length, expire)
+            self._file.close()
+            self._reader.close()
+            os.replace(tmp_path, self._path)
+            self._index = index
+            self._file = open(self._path, "ab")
+            self._size = self._flushed_size = self._file.tell()
+            self._reader = open(self._path, "rb")
+            logger.info(f"ResponseCache compacted to {self._size / 2 ** 20:.1f} MiB, "
+                        f"cost {time.perf_counter() - start:.2f}s")
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            self._bg_compact_task = None
+
+    def report(self):
+        total = self.hits + self.misses
+        logger.info(f"ResponseCache: {len(self._index)} record(s), {self._live_bytes / 2 ** 20:.1f} MiB, "
+                    f"hits={self.hits}, misses={self.misses}, "
+                    f"hit rate={self.hits / total if total else 0:.1%}")
+
+    async def close(self):
+        if self._bg_compact_task:
+            await self._bg_compact_task
+        if self._file:
+            self.__flush_buffer()
+            if self.__need_compact():
+                await self.__compact()
+            self._file.close()
+            self._reader.close()
+            self._file = None
@@ -0,0 +1,63 @@
+import heapq
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+__all__ = ["RetryScheduler"]
+
+
+class RetryScheduler:
+    """
+    Schedule failed mids to retry with exponential backoff and jitter.
+    A mid failed `max_attempts` times is given up (dead letter).
+    """
+
+    def __init__(self, max_attempts: int, base_delay: float, max_delay: float, jitter: float):
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._jitter = jitter  # 0.5 means delay * [0.5, 1.5)
+        self._heap: List[Tuple[float, int]] = []  # (due time, mid)
+        self._attempts: Dict[int, int] = {}  # mid -> failed times
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def attempts(self, mid: int) -> int:
+        return self._attempts.get(mid, 0)
+
+    def should_give_up(self, attempts: int) -> bool:
+        """The mid failed `attempts` times, give it up"""
+        return attempts >= self._max_attempts
+
+    def delay(self, attempts: int) -> float:
+        """Seconds to wait before retrying a mid failed `attempts` times"""
+        delay = min(self._max_delay, self._base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(1 - self._jitter, 1 + self._jitter)
+
+    def schedule(self, mid: int) -> bool:
+        """Schedule a failed mid, return False if the mid should be given up"""
+        attempts = self._attempts.get(mid, 0) + 1
+        if self.should_give_up(attempts):
+            self._attempts.pop(mid, None)
+            return False
+        self._attempts[mid] = attempts
+        heapq.heappush(self._heap, (time.monotonic() + self.delay(attempts), mid))
+        return True
+
+    def forget(self, mid: int):
+        """The mid is processed, reset its attempts"""
+        self._attempts.pop(mid, None)
+
+    def next_due(self) -> Optional[float]:
+        """Seconds until the next retry is due, None if nothing is scheduled"""
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.monotonic())
+
+    def pop_due(self) -> List[int]:
+        now = time.monotonic()
+        mids = []
+        while self._heap and self._heap[0][0] <= now:
+            mids.append(heapq.heappop(self._heap)[1])
+        return mids
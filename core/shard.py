@@ -0,0 +1,122 @@
+import asyncio
+import config
+import glob
+import os
+from multiprocessing import Queue
+from typing import Dict, Iterable, List, Set, Tuple
+from utils.log import logger
+
+__all__ = ["shard_of", "configure_shard", "find_shard_paths", "ShardRouter"]
+
+
+def shard_of(mid: int, shards: int) -> int:
+    """The shard owning the mid, mids are mixed first so that nearby mids are spread"""
+    return (((mid * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32) % shards
+
+
+def _shard_path(path: str, shard_id: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard_id}{ext}"
+
+
+def find_shard_paths(path: str) -> List[str]:
+    """The files of the shards written to `path` by a multi-process crawl"""
+    root, ext = os.path.splitext(path)
+    return sorted(glob.glob(f"{glob.escape(root)}.shard[0-9]*{glob.escape(ext)}"))
+
+
+def configure_shard(shard_id: int):
+    """Every shard process has its own files, call it before creating anything reading them"""
+    for key in ("file", "legacy_file", "wal_file"):
+        config.MID_POOL[key] = _shard_path(config.MID_POOL[key], shard_id)
+    negative_cache = config.MID_POOL["negative_cache"]
+    negative_cache["file"] = _shard_path(negative_cache["file"], shard_id)
+    config.SPIDER_CONFIG["save_path"] = _shard_path(config.SPIDER_CONFIG["save_path"], shard_id)
+    cache = config.HTTP_CLIENT["cache"]
+    cache["path"] = _shard_path(cache["path"], shard_id)
+    config.PROXY_POOL["stats_file"] = _shard_path(config.PROXY_POOL["stats_file"], shard_id)
+
+
+class ShardRouter:
+    """
+    Route mids to the shard owning them. Mids of this shard go to the local MidPool,
+    the others are batched and sent to the inbox of their shard, a message is a list of (score, mids).
+    """
+
+    _STOP = None
+
+    def __init__(self, shard_id: int, inboxes: List[Queue]):
+        self._shard_id = shard_id
+        self._shards = len(inboxes)
+        self._inboxes = inboxes
+        self._batch_size = config.SHARD["batch_size"]
+        self._flush_interval = config.SHARD["flush_interval"]
+        self._outboxes: Dict[int, List[Tuple[float, List[int]]]] = {}
+        self._outbox_sizes: Dict[int, int] = {}
+        self._mid_pool = None
+        self._bg_receive_task = None
+        self._bg_flush_task = None
+        self._sent = 0
+        self._received = 0
+
+    def init(self, mid_pool):
+        self._mid_pool = mid_pool
+        self._bg_receive_task = asyncio.create_task(self.__receive_task())
+        self._bg_receive_task.set_name("ShardReceiveTask")
+        self._bg_flush_task = asyncio.create_task(self.__flush_task())
+        self._bg_flush_task.set_name("ShardFlushTask")
+
+    def owns(self, mid: int) -> bool:
+        return shard_of(mid, self._shards) == self._shard_id
+
+    def filter_owned(self, mids: Iterable[int]) -> Set[int]:
+        return {mid for mid in mids if self.owns(mid)}
+
+    async def add_mid_set(self, mids: Set[int], score: float = 1.0):
+        local = set()
+        foreign: Dict[int, List[int]] = {}
+        for mid in mids:
+            shard = shard_of(mid, self._shards)
+            if shard == self._shard_id:
+                local.add(mid)
+            else:
+                foreign.setdefault(shard, []).append(mid)
+
+        for shard, shard_mids in foreign.items():
+            self._outboxes.setdefault(shard, []).append((score, shard_mids))
+            self._outbox_sizes[shard] = self._outbox_sizes.get(shard, 0) + len(shard_mids)
+            if self._outbox_sizes[shard] >= self._batch_size:
+                self.__send(shard)
+        if local:
+            await self._mid_pool.add_mid_set(local, score)
+
+    def __send(self, shard: int):
+        batch = self._outboxes.pop(shard, None)
+        self._sent += self._outbox_sizes.pop(shard, 0)
+        if batch:
+            self._inboxes[shard].put(batch)  # pickled and sent by the feeder thread, not blocking
+
+    async def __flush_task(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            for shard in list(self._outboxes):
+                self.__send(shard)
+
+    async def __receive_task(self):
+        inbox = self._inboxes[self._shard_id]
+        while True:
+            batch = await asyncio.to_thread(inbox.get)
+            if batch is self._STOP:
+                break
+            for score, mids in batch:
+                self._received += len(mids)
+                await self._mid_pool.add_mid_set(set(mids), score)
+
+    async def stop(self):
+        self._bg_flush_task.cancel()
+        for shard in list(self._outboxes):
+            self.__send(shard)
+        # wake up the receiving thread, or the process can't exit
+        self._inboxes[self._shard_id].put(self._STOP)
+        await self._bg_receive_task
+        logger.info(f"Shard {self._shard_id} stopped, sent {self._sent} mids, received {self._received} mids")
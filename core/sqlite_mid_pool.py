@@ -0,0 +1,280 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Deque, List, Optional, Set, Tuple
+import asyncio
+import config
+import os
+import socket
+import sqlite3
+import time
+from core.negative_cache import NegativeCache
+from core.retry_scheduler import RetryScheduler
+from utils.log import logger
+
+__all__ = ["SqliteMidPool"]
+
+STATE_TO_PROCESS = 0
+STATE_LEASED = 1
+STATE_PROCESSED = 2
+STATE_FAILED = 3  # waiting for retry
+STATE_DEAD = 4  # failed too many times, given up
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mids (
+    mid INTEGER PRIMARY KEY,
+    state INTEGER NOT NULL,
+    score REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    due REAL NOT NULL DEFAULT 0,  -- lease deadline if leased, retry time if failed
+    node TEXT  -- the node holding the lease
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS mids_to_process ON mids(score DESC) WHERE state = 0;
+CREATE INDEX IF NOT EXISTS mids_due ON mids(due) WHERE state IN (1, 3);
+"""
+
+
+class SqliteMidPool:
+    """
+    MidPool backed by a SQLite database shared by the crawl nodes, with the same API as MidPool.
+    Nodes claim mids in batches with a lease in one transaction, so a mid is crawled by one node at a time,
+    the leases of a crashed node expire and the mids are claimed by the others.
+    Adding mids is deduplicated by the database, mids already known are only scored up.
+    The database is accessed in one thread, acks are written in batches.
+    """
+
+    def __init__(self) -> None:
+        sqlite_config = config.MID_POOL["sqlite"]
+        self._file = sqlite_config["file"]
+        self._node = sqlite_config["node"] or f"{socket.gethostname()}-{os.getpid()}"
+        self._claim_batch = sqlite_config["claim_batch"]
+        self._poll_interval = sqlite_config["poll_interval"]
+        self._flush_interval = sqlite_config["flush_interval"]
+        self._lease_timeout = config.MID_POOL["lease_timeout"]
+        # only the backoff policy is used, the schedule is kept in the database
+        self._retry_policy = RetryScheduler(**config.MID_POOL["retry"])
+        self._negative_cache = NegativeCache(**config.MID_POOL["negative_cache"])
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="SqliteMidPool")
+        self._db = None
+        self._claimed: Deque[int] = deque()  # claimed by this node, not handed out yet
+        self._held: Set[int] = set()  # claimed by this node, not acked yet
+        self._acks: List[Tuple[int, bool]] = []  # (mid, processed), not written yet
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._claim_event = None
+        self._draining = False
+        self._drained = None
+        self._bg_load_task = None
+        self._bg_claim_task = None
+        self._bg_flush_task = None
+        self._before_flush = None
+
+    # ---------- run in the database thread ----------
+
+    def __open(self):
+        self._db = sqlite3.connect(self._file, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+
+    def __transaction(self, func, *args):
+        # IMMEDIATE takes the write lock at once, a claim is never interleaved with the other nodes
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(*args)
+            self._db.execute("COMMIT")
+            return result
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+    def __db_claim(self, n: int) -> List[int]:
+        now = time.time()  # wall clock, shared by the nodes
+        # expired leases and due retries are ready again
+        self._db.execute("UPDATE mids SET state=0, node=NULL WHERE state IN (1, 3) AND due<=?", (now,))
+        rows = self._db.execute(
+            "UPDATE mids SET state=1, node=?, due=? WHERE mid IN "
+            "(SELECT mid FROM mids WHERE state=0 ORDER BY score DESC LIMIT ?) RETURNING mid",
+            (self._node, now + self._lease_timeout, n)).fetchall()
+        return [row[0] for row in rows]
+
+    def __db_add(self, mids: List[int], score: float):
+        self._db.executemany(
+            "INSERT INTO mids(mid, state, score) VALUES (?, 0, ?) "
+            "ON CONFLICT(mid) DO UPDATE SET score=score+excluded.score WHERE state=0",
+            ((mid, score) for mid in mids))
+
+    def __db_ack(self, acks: List[Tuple[int, bool]]) -> List[int]:
+        now = time.time()
+        dead = []
+        for mid, processed in acks:
+            if processed:
+                self._db.execute("UPDATE mids SET state=2, node=NULL, attempts=0 WHERE mid=?", (mid,))
+                continue
+            row = self._db.execute("SELECT attempts FROM mids WHERE mid=?", (mid,)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            if self._retry_policy.should_give_up(attempts):
+                self._db.execute("UPDATE mids SET state=4, node=NULL, attempts=? WHERE mid=?", (attempts, mid))
+                dead.append(mid)
+                continue
+            self._db.execute("UPDATE mids SET state=3, node=NULL, attempts=?, due=? WHERE mid=?",
+                             (attempts, now + self._retry_policy.delay(attempts), mid))
+        return dead
+
+    def __db_renew(self, mids: List[int]):
+        due = time.time() + self._lease_timeout
+        self._db.executemany("UPDATE mids SET due=? WHERE mid=? AND node=? AND state=1",
+                             ((due, mid, self._node) for mid in mids))
+
+    def __db_release(self, mids: List[int]):
+        self._db.executemany("UPDATE mids SET state=0, node=NULL WHERE mid=? AND node=? AND state=1",
+                             ((mid, self._node) for mid in mids))
+
+    def __db_close(self, acks: List[Tuple[int, bool]], unused: List[int]):
+        self.__transaction(self.__db_ack, acks)
+        self.__transaction(self.__db_release, unused)
+        self._db.close()
+
+    # ---------- run in the event loop ----------
+
+    async def __run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.__transaction, func, *args)
+
+    def init(self, before_flush: Optional[Callable[[], Awaitable]] = None):
+        """`before_flush` flushes the output, it's awaited before the acks are written"""
+        self._before_flush = before_flush
+        self._claim_event = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._executor.submit(self.__open).result()
+        logger.info(f"SqliteMidPool opened {self._file}, node={self._node}")
+
+        self._bg_load_task = asyncio.create_task(self._negative_cache.load())
+        self._bg_load_task.set_name("NegativeCacheLoadTask")
+        self._bg_claim_task = asyncio.create_task(self.__claim_task())
+        self._bg_claim_task.set_name("MidClaimTask")
+        self._bg_flush_task = asyncio.create_task(self.__flush_task())
+        self._bg_flush_task.set_name("MidAckFlushTask")
+
+    def stop(self):
+        logger.info("Stop SqliteMidPool...")
+        for task in (self._bg_load_task, self._bg_claim_task, self._bg_flush_task):
+            if not task.cancelled():
+                task.cancel()
+        self._negative_cache.close()
+        # write the acks left, give back the mids not handed out
+        acks, self._acks = self._acks, []
+        unused = list(self._claimed)
+        self._claimed.clear()
+        self._executor.submit(self.__db_close, acks, unused).result()
+        self._executor.shutdown()
+
+    def __wakeup_waiters(self):
+        while self._waiters and self._claimed and not self._draining:
+            waiter = self._waiters.popleft()
+            if not waiter.done():  # skip the cancelled
+                waiter.set_result(self._claimed.popleft())
+
+    async def __claim_task(self):
+        logger.info("Mid claim task running...")
+        while True:
+            await self._claim_event.wait()
+            self._claim_event.clear()
+            while self._waiters and not self._draining:
+                mids = await self.__run(self.__db_claim, self._claim_batch)
+                if not mids:
+                    # nothing to process now, the other nodes may add some later
+                    await asyncio.sleep(self._poll_interval)
+                    continue
+                self._claimed.extend(mids)
+                self._held.update(mids)
+                self.__wakeup_waiters()
+
+    async def __flush_task(self):
+        logger.info("Mid ack flush task running...")
+        last_renew = time.monotonic()
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await self._negative_cache.flush()
+            if self._acks:
+                acks, self._acks = self._acks, []
+                # an acked mid is durable only after its record is, flush the storage first
+                if self._before_flush:
+                    await self._before_flush()
+                for mid in await self.__run(self.__db_ack, acks):
+                    logger.error(f"Give up failed {mid=}")
+            # keep the leases of the mids held alive, the leases of a crashed node expire
+            if time.monotonic() - last_renew >= self._lease_timeout / 3:
+                last_renew = time.monotonic()
+                await self.__run(self.__db_renew, list(self._held))
+
+    def __ack(self, mid: int, processed: bool):
+        self._held.discard(mid)
+        self._acks.append((mid, processed))
+        if self._draining and not self._held:
+            self._drained.set()
+
+    async def drain(self, timeout: float):
+        """Stop handing out mids, and wait for the leased mids to be acked until timeout"""
+        self._draining = True
+        if self._claimed:
+            unused = list(self._claimed)
+            self._claimed.clear()
+            self._held.difference_update(unused)
+            await self.__run(self.__db_release, unused)
+        if not self._held:
+            return
+        logger.info(f"Drain SqliteMidPool, wait for {len(self._held)} leased mid(s), {timeout=}s")
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout)
+            logger.info("SqliteMidPool is drained")
+        except asyncio.TimeoutError:
+            # their leases expire, and they are claimed again
+            logger.warning(f"Drain SqliteMidPool timeout, {len(self._held)} leased mid(s) are not acked")
+
+    async def add_processed_mid(self, mid: int):
+        logger.debug(f"Add a proceed {mid=}")
+        self.__ack(mid, True)
+
+    async def add_dropped_mid(self, mid: int, follower: int):
+        """The mid is processed but dropped for too few followers, skip it in the later runs"""
+        self.__ack(mid, True)
+        self._negative_cache.add(mid, follower)
+
+    async def add_failed_mid(self, mid: int):
+        logger.warning(f"Add failed {mid=}")
+        self.__ack(mid, False)
+
+    async def add_mid_set(self, mids: Set[int], score: float = 1.0):
+        """Add mids to process, the known mids are skipped by the database, or scored up if not processed yet"""
+        # known tiny accounts are skipped until they are due for recheck
+        await self._bg_load_task
+        mids = self._negative_cache.filter(mids)
+        if not mids:
+            return
+        await self.__run(self.__db_add, list(mids), score)
+        logger.info(f"Add {len(mids)} mid(s)")
+        if self._waiters:
+            self._claim_event.set()
+
+    async def get_mid(self) -> int:
+        """Get a mid to process, it must be acked by add_processed_mid/add_failed_mid"""
+        if self._claimed and not self._waiters and not self._draining:
+            return self._claimed.popleft()
+
+        logger.debug("Wait a mid...")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._claim_event.set()
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            # cancelled after a mid is handed over, put it back
+            if waiter.done() and not waiter.cancelled():
+                self._claimed.appendleft(waiter.result())
+                self.__wakeup_waiters()
+            raise
+
+    async def get_many(self, n: int) -> List[int]:
+        """Get 1~n mids, wait if there is no mid to process"""
+        mids = [await self.get_mid()]
+        while len(mids) < n and self._claimed and not self._draining:
+            mids.append(self._claimed.popleft())
+        return mids
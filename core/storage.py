@@ -1,65 +1,449 @@
 from hdfs.client import Client
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import dataclasses
+import os
 import queue
-from threading import Thread, Lock
+import time
+from threading import Event, Thread
 import config
+from core.codec import encode_up_info, encode_video_info
+from core.models import BaseUserInfo, SubmitVideoDetails, UpInfo
 from utils.log import logger
 import aiofiles
 
 
+class _BufferedFile:
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        self.lock = asyncio.Lock()  # keep the order of batches
+        self.buffer: List[str] = []
+        self.size = 0
+        self.first_write_time = 0.0
+
+
 class LocalStorage:
+    """
+    Records are buffered in memory and written to a long-lived file handle in batches,
+    a batch is flushed when it's large enough, has enough records, or is too old.
+    """
+
+    def __init__(self):
+        self._max_buffer_size = config.STORAGE["local"]["max_buffer_size"]
+        self._max_buffer_records = config.STORAGE["local"]["max_buffer_records"]
+        self._max_buffer_latency = config.STORAGE["local"]["max_buffer_latency"]
+        self._files: Dict[str, _BufferedFile] = {}
+        self._bg_flush_task = None
 
     async def write(self, data: str, path: str):
-        async with aiofiles.open(path, 'a+', encoding="utf-8") as f:
-            await f.write(data)
-            await f.write("\n")
-        logger.debug(f"Written {len(data)} byets to {path}")
+        buffered = self._files.get(path)
+        if buffered is None:
+            buffered = self._files[path] = _BufferedFile(path)
+        if not buffered.buffer:
+            buffered.first_write_time = time.monotonic()
+        buffered.buffer.append(data)
+        buffered.buffer.append("\n")
+        buffered.size += len(data) + 1
+
+        if self._bg_flush_task is None:
+            self._bg_flush_task = asyncio.create_task(self.__flush_task())
+            self._bg_flush_task.set_name("LocalStorageFlushTask")
+        if buffered.size >= self._max_buffer_size or len(buffered.buffer) >= 2 * self._max_buffer_records:
+            await self.__flush(buffered)
+
+    async def __flush(self, buffered: _BufferedFile):
+        if not buffered.buffer:
+            return
+        # swap the buffer, new records go to the new one while writing
+        data = "".join(buffered.buffer)
+        records = len(buffered.buffer) // 2
+        buffered.buffer = []
+        buffered.size = 0
+        async with buffered.lock:
+            if buffered.file is None:
+                buffered.file = await aiofiles.open(buffered.path, "a+", encoding="utf-8")
+            await buffered.file.write(data)
+            await buffered.file.flush()
+        logger.debug(f"Written {records} record(s), {len(data)} characters to {buffered.path}")
+
+    async def __flush_task(self):
+        while True:
+            await asyncio.sleep(self._max_buffer_latency / 2)
+            now = time.monotonic()
+            for buffered in list(self._files.values()):
+                if buffered.buffer and now - buffered.first_write_time >= self._max_buffer_latency:
+                    await self.__flush(buffered)
+
+    async def write_up_info(self, info: UpInfo, path: str):
+        await self.write(encode_up_info(info), path)
+
+    async def write_videos(self, mid: int, videos: List[SubmitVideoDetails.VideoInfo], path: str):
+        """Video records of the up saved at `path`, written to `<path>.video`"""
+        for video in videos:
+            await self.write(encode_video_info(mid, video), f"{path}.video")
+
+    async def flush(self):
+        for buffered in list(self._files.values()):
+            await self.__flush(buffered)
+
+    async def close(self):
+        if self._bg_flush_task:
+            self._bg_flush_task.cancel()
+            self._bg_flush_task = None
+        await self.flush()
+        for buffered in self._files.values():
+            async with buffered.lock:
+                if buffered.file:
+                    await buffered.file.close()
+                    buffered.file = None
+        self._files.clear()
+        logger.info("LocalStorage is closed")
+
+
+class _HdfsPart:
+
+    def __init__(self, path: str):
+        self.path = path
+        self.size = 0
+        self.created_time = time.monotonic()
 
 
 class HdfsStorage(Thread):
+    """
+    Records are queued and written by a background thread in batches.
+    Each logical path is a directory of rolling part files, a part is rolled
+    when it's large enough or too old, a batch is appended to the current part.
+    """
+
+    _STOP = object()
 
     def __init__(self) -> None:
         super(HdfsStorage, self).__init__()
+        self.daemon = True
         self._client = Client(
             url=config.HDFS.get("host"),
             root=config.HDFS.get("root_path")
         )
-        # self._lock = Lock()
-        self._is_stop = False
+        self._batch_size = config.HDFS["batch_size"]
+        self._batch_latency = config.HDFS["batch_latency"]
+        self._roll_size = config.HDFS["roll_size"]
+        self._roll_interval = config.HDFS["roll_interval"]
+        self._max_retries = config.HDFS["max_retries"]
+        self._retry_delay = config.HDFS["retry_delay"]
+        self._fallback_path = config.HDFS["fallback_path"]
         self._msg_queue = queue.Queue()
+        # used by the background thread only
+        self._batches: Dict[str, List[str]] = {}
+        self._batch_sizes: Dict[str, int] = {}
+        self._batch_times: Dict[str, float] = {}
+        self._parts: Dict[str, _HdfsPart] = {}
+        self._part_seq = 0
+
+    def __ensure_started(self):
+        # started on the first use instead of creating, a thread started before
+        # forking the shard processes is not running in them
+        if self.ident is None:
+            self.start()
+
+    async def write(self, data: str, path: str):
+        self.__ensure_started()
+        self._msg_queue.put((data, path))
+
+    async def write_up_info(self, info: UpInfo, path: str):
+        await self.write(encode_up_info(info), path)
 
-    def write(self, data: str, path: str):
-        self._msg_queue.put({
-            "data": data,
-            "path": path
-        })
-
-    def _write_to_hdfs(self, data: str, path: str):
-        # TODO: batch write request
-        try:
-            with self._client.write(path, append=False, encoding="utf-8") as writer:
-                writer.write(data)
-                writer.write("\n")
-            logger.info(f"Written {len(data)} byets to {path}")
-        except Exception as e:
-            print(e)
+    async def write_videos(self, mid: int, videos: List[SubmitVideoDetails.VideoInfo], path: str):
+        """Video records of the up saved at `path`, written to `<path>.video`"""
+        for video in videos:
+            await self.write(encode_video_info(mid, video), f"{path}.video")
+
+    async def flush(self):
+        self.__ensure_started()
+        flushed = Event()
+        self._msg_queue.put(flushed)
+        await asyncio.to_thread(flushed.wait)
+
+    async def close(self):
+        await asyncio.to_thread(self.wait_finish)
 
     def wait_finish(self):
-        self._is_stop = True
-        self.join()
+        if self.is_alive():
+            self._msg_queue.put(self._STOP)
+            self.join()
+
+    def __next_part(self, path: str) -> _HdfsPart:
+        self._part_seq += 1
+        name = f"part-{time.strftime('%Y%m%d%H%M%S')}-{self._part_seq:05d}"
+        part = self._parts[path] = _HdfsPart(f"{path}/{name}")
+        return part
+
+    def __write_batch(self, path: str):
+        records = self._batches.pop(path, None)
+        self._batch_sizes.pop(path, None)
+        self._batch_times.pop(path, None)
+        if not records:
+            return
+        data = "".join(records)
+        for attempt in range(1, self._max_retries + 1):
+            part = self._parts.get(path)
+            if part is None or part.size >= self._roll_size \
+                    or time.monotonic() - part.created_time >= self._roll_interval:
+                part = self.__next_part(path)
+            try:
+                # the first batch creates the part, the others are appended
+                self._client.write(part.path, data, append=part.size > 0, encoding="utf-8")
+                part.size += len(data)
+                logger.debug(f"Written {len(records) // 2} record(s), {len(data)} characters to {part.path}")
+                return
+            except Exception as e:
+                logger.warning(f"Write to {part.path} failed ({attempt}/{self._max_retries}): {e}")
+                # a failed append may leave a partial batch, retry in a new part
+                self._parts.pop(path, None)
+                time.sleep(self._retry_delay * 2 ** (attempt - 1))
+
+        logger.error(f"Give up writing {len(records) // 2} record(s) to {path}, saved to {self._fallback_path}")
+        with open(self._fallback_path, "a", encoding="utf-8") as f:
+            f.write(data)
+
+    def __next_timeout(self) -> Optional[float]:
+        if not self._batch_times:
+            return None
+        oldest = min(self._batch_times.values())
+        return max(0.0, oldest + self._batch_latency - time.monotonic())
 
     def run(self) -> None:
         logger.info("HdfsStorage Thread running")
-        while not self._is_stop or not self._msg_queue.empty():
-            while not self._msg_queue.empty():
-                kwargs = self._msg_queue.get()
-                self._write_to_hdfs(**kwargs)
+        while True:
+            try:
+                # block until a record comes or the oldest batch is due
+                msg = self._msg_queue.get(timeout=self.__next_timeout())
+            except queue.Empty:
+                msg = None
+
+            if msg is self._STOP or isinstance(msg, Event):
+                for path in list(self._batches):
+                    self.__write_batch(path)
+                if msg is self._STOP:
+                    break
+                msg.set()
+            elif msg is not None:
+                data, path = msg
+                if path not in self._batches:
+                    self._batches[path] = []
+                    self._batch_sizes[path] = 0
+                    self._batch_times[path] = time.monotonic()
+                self._batches[path].append(data)
+                self._batches[path].append("\n")
+                self._batch_sizes[path] += len(data) + 1
+                if self._batch_sizes[path] >= self._batch_size:
+                    self.__write_batch(path)
+
+            now = time.monotonic()
+            for path, first_time in list(self._batch_times.items()):
+                if now - first_time >= self._batch_latency:
+                    self.__write_batch(path)
         logger.info("HdfsStorage Thread stopped")
 
 
+class _ParquetTable:
+
+    def __init__(self, path: str, schema):
+        self.path = path  # a directory of part files
+        self.schema = schema
+        self.writer = None
+        self.part_path = None
+        self.part_row_groups = 0
+        self.columns: Dict[str, list] = {name: [] for name in schema.names}
+        self.rows = 0
+
+
+class ParquetStorage:
+    """
+    UpInfo records are written column by column into two tables of Parquet part files:
+    `<path>.up/` with one row per up, and `<path>.video/` with one row per video.
+    A row group is written when enough rows are buffered, a part is closed (readable) after
+    `roll_row_groups` row groups or close(), every part is a new file, an existing one is never reopened.
+    """
+
+    def __init__(self):
+        # optional dependency, only needed when this storage is used
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self._pa = pa
+        self._pq = pq
+        self._row_group_size = config.STORAGE["parquet"]["row_group_size"]
+        self._compression = config.STORAGE["parquet"]["compression"]
+        self._roll_row_groups = config.STORAGE["parquet"]["roll_row_groups"]
+        self._part_seq = 0
+        self._up_schema = pa.schema([
+            ("mid", pa.int64()),
+            ("name", pa.string()),
+            ("sex", pa.string()),
+            ("sign", pa.string()),
+            ("avatar_url", pa.string()),
+            ("level", pa.int8()),
+            ("vip_type", pa.int8()),
+            ("offical_type", pa.int8()),
+            ("offical_title", pa.string()),
+            ("is_banned", pa.bool_()),
+            ("school", pa.string()),
+            ("birthday", pa.string()),
+            ("hard_vip", pa.bool_()),
+            ("following", pa.int64()),
+            ("follower", pa.int64()),
+            ("charge_enable", pa.bool_()),
+            ("charge_total", pa.int64()),
+            ("charge_month", pa.int64()),
+            ("total_videos", pa.int64()),
+            ("total_plays", pa.int64()),
+            ("total_comments", pa.int64()),
+            ("total_danmaku", pa.int64()),
+            ("partition", pa.list_(pa.struct([("tid", pa.int32()), ("count", pa.int64())]))),
+        ])
+        self._video_schema = pa.schema([
+            ("mid", pa.int64()),
+            ("avid", pa.int64()),
+            ("bvid", pa.string()),
+            ("comments", pa.int64()),
+            ("plays", pa.int64()),  # null if the plays is hidden
+            ("danmaku", pa.int64()),
+            ("tid", pa.int32()),
+            ("created", pa.int64()),
+            ("title", pa.string()),
+            ("duration", pa.int64()),
+            ("is_union", pa.bool_()),
+        ])
+        # models are slotted, fields are read by name
+        self._base_fields = [field.name for field in dataclasses.fields(BaseUserInfo)]
+        self._video_fields = [field.name for field in dataclasses.fields(SubmitVideoDetails.VideoInfo)]
+        self._tables: Dict[str, Tuple[_ParquetTable, _ParquetTable]] = {}
+        self._lock = asyncio.Lock()  # keep the order of row groups
+
+    def __tables(self, path: str) -> Tuple[_ParquetTable, _ParquetTable]:
+        tables = self._tables.get(path)
+        if tables is None:
+            tables = self._tables[path] = (
+                _ParquetTable(f"{path}.up", self._up_schema),
+                _ParquetTable(f"{path}.video", self._video_schema)
+            )
+        return tables
+
+    async def write_up_info(self, info: UpInfo, path: str):
+        tables = self.__tables(path)
+        up_table, video_table = tables
+        mid = info.base.mid
+
+        columns = up_table.columns
+        for name in self._base_fields:
+            columns[name].append(getattr(info.base, name))
+        columns["following"].append(info.relation.following)
+        columns["follower"].append(info.relation.follower)
+        columns["charge_enable"].append(info.charge.enable)
+        columns["charge_total"].append(info.charge.total)
+        columns["charge_month"].append(info.charge.month)
+        columns["total_videos"].append(info.video.total_videos)
+        columns["total_plays"].append(info.video.total_plays)
+        columns["total_comments"].append(info.video.total_comments)
+        columns["total_danmaku"].append(info.video.total_danmaku)
+        columns["partition"].append([{"tid": p.tid, "count": p.count} for p in info.video.partition])
+        up_table.rows += 1
+
+        self.__append_videos(video_table, mid, info.video.videos)
+
+        for table in tables:
+            if table.rows >= self._row_group_size:
+                await self.__write_row_group(table)
+
+    async def write_videos(self, mid: int, videos: List[SubmitVideoDetails.VideoInfo], path: str):
+        """Video records of the up saved at `path`, appended to its video table"""
+        video_table = self.__tables(path)[1]
+        self.__append_videos(video_table, mid, videos)
+        if video_table.rows >= self._row_group_size:
+            await self.__write_row_group(video_table)
+
+    def __append_videos(self, video_table: _ParquetTable, mid: int, videos: List[SubmitVideoDetails.VideoInfo]):
+        columns = video_table.columns
+        for video in videos:
+            columns["mid"].append(mid)
+            for name in self._video_fields:
+                columns[name].append(getattr(video, name))
+            if type(video.plays) != int:
+                columns["plays"][-1] = None
+        video_table.rows += len(videos)
+
+    def __next_part(self, table: _ParquetTable) -> str:
+        os.makedirs(table.path, exist_ok=True)
+        while True:
+            self._part_seq += 1
+            part_path = f"{table.path}/part-{time.strftime('%Y%m%d%H%M%S')}-{self._part_seq:05d}.parquet"
+            if not os.path.exists(part_path):  # ParquetWriter truncates the file
+                return part_path
+
+    @staticmethod
+    def __close_part(table: _ParquetTable):
+        table.writer.close()  # write the footer
+        table.writer = None
+        table.part_row_groups = 0
+        logger.debug(f"Closed Parquet part {table.part_path}")
+
+    def __write_table(self, table: _ParquetTable, columns: Dict[str, list]):
+        if table.writer is None:
+            table.part_path = self.__next_part(table)
+            table.writer = self._pq.ParquetWriter(table.part_path, table.schema, compression=self._compression)
+        batch = self._pa.Table.from_pydict(columns, schema=table.schema)
+        table.writer.write_table(batch)
+        table.part_row_groups += 1
+        if table.part_row_groups >= self._roll_row_groups:
+            self.__close_part(table)
+
+    async def __write_row_group(self, table: _ParquetTable):
+        if not table.rows:
+            return
+        # swap the columns, new rows go to the new ones while writing
+        columns = table.columns
+        rows = table.rows
+        table.columns = {name: [] for name in table.schema.names}
+        table.rows = 0
+        async with self._lock:
+            # encoding and compression take a while, don't block the event loop
+            await asyncio.to_thread(self.__write_table, table, columns)
+        logger.debug(f"Written {rows} row(s) to {table.path}")
+
+    async def flush(self):
+        for tables in list(self._tables.values()):
+            for table in tables:
+                await self.__write_row_group(table)
+
+    async def close(self):
+        await self.flush()
+        async with self._lock:
+            for tables in self._tables.values():
+                for table in tables:
+                    if table.writer:
+                        self.__close_part(table)
+        self._tables.clear()
+        logger.info("ParquetStorage is closed")
+
+
+def make_storage():
+    """Create the global storage, the implementation is chosen by config"""
+    backend = config.STORAGE.get("backend")
+    if backend == "hdfs":
+        return HdfsStorage()
+    if backend == "parquet":
+        return ParquetStorage()
+    return LocalStorage()
+
+
 # global storage
-storage = LocalStorage()
-# storage.start()
+storage = make_storage()
 
 if __name__ == "__main__":
-    storage.write("hello world", "test.txt")
-    storage.wait_finish()
+    async def test():
+        hdfs_storage = HdfsStorage()
+        await hdfs_storage.write("hello world", "test")
+        await hdfs_storage.close()
+
+    asyncio.run(test())
@@ -1,21 +1,33 @@
 import config
 from core.http_client import HttpClient
-from core.mid_pool import MidPool
+from core.mid_pool import make_mid_pool
 from core.models import *
 from utils.log import logger
-from typing import Optional, Set
+from utils.statistics import LatencyRecorder
+from typing import AsyncIterator, Awaitable, List, Optional, Set
+from collections import deque
 import math
+import time
 import asyncio
 from core.storage import storage
+from core.shard import ShardRouter, configure_shard, find_shard_paths
+from core.recrawl_scheduler import RecrawlScheduler
+import multiprocessing
 
 
 class UpInfoSpider:
 
-    def __init__(self):
+    def __init__(self, router: Optional[ShardRouter] = None):
         self._client = HttpClient()
-        self._mid_pool = MidPool()
+        self._mid_pool = make_mid_pool()
+        self._router = router  # routes mids to other shards in multi-process mode
         self._save_path = config.SPIDER_CONFIG.get("save_path")
         self._parallel_co_tasks = config.SPIDER_CONFIG.get("parallel_co_tasks")
+        self._drain_timeout = config.SPIDER_CONFIG.get("drain_timeout")
+        self._report_interval = config.SPIDER_CONFIG.get("report_interval")
+        self._video_page_concurrency = config.SPIDER_CONFIG.get("video_page_concurrency")
+        self._stream_videos = config.SPIDER_CONFIG.get("stream_videos")
+        self._latency = LatencyRecorder("process_up_info")
 
     async def get_base_user_info(self, mid: int) -> Optional[BaseUserInfo]:
         api = "http://api.bilibili.com/x/space/acc/info"
@@ -62,64 +74,110 @@ class UpInfoSpider:
                 total=data["total_count"],
             )
 
-    async def __get_video_nums(self, mid: int):
-        api = "http://api.bilibili.com/x/space/arc/search"
-        data = await self._client.get_json_data(api, params={"mid": mid, "pn": 1, "ps": 1})
-        return data["page"]["count"] if data else None
-
     async def __get_one_page_videos(self, mid: int, page: int, page_size: int):
         api = "http://api.bilibili.com/x/space/arc/search"
         return await self._client.get_json_data(api, params={"mid": mid, "pn": page, "ps": page_size})
 
+    @staticmethod
+    def __add_video_page(details: SubmitVideoDetails, data: dict) -> List[SubmitVideoDetails.VideoInfo]:
+        """Parse the videos of a page, add them up to the totals of details"""
+        if not details.partition:
+            for part in (data["list"]["tlist"] or {}).values():  # null for ups without videos
+                details.partition.append(SubmitVideoDetails.VideoPartitionInfo(
+                    tid=part["tid"], count=part["count"]))
+
+        videos = []
+        for video in data["list"]["vlist"]:
+            details.total_plays += video["play"] if type(
+                video["play"]) == int else 0
+            details.total_comments += video["comment"]
+            details.total_danmaku += video["video_review"]
+            videos.append(SubmitVideoDetails.VideoInfo(
+                avid=video["aid"],
+                bvid=video["bvid"],
+                title=video["title"],
+                # desc=video["description"],
+                comments=video["comment"],
+                plays=video["play"],
+                danmaku=video["video_review"],
+                tid=video["typeid"],
+                created=video["created"],
+                # "127:31" min:sec
+                duration=sum(map(int, video["length"].split(":"))),
+                is_union=bool(video["is_union_video"])
+            ))
+        return videos
+
     async def get_submit_video_details(self, mid: int) -> Optional[SubmitVideoDetails]:
-        total_videos = await self.__get_video_nums(mid)
-        if total_videos is None:
+        # the first page tells how many videos there are
+        page_size = 50
+        first_page = await self.__get_one_page_videos(mid, 1, page_size)
+        if first_page is None:
             return None
+        total_videos = first_page["page"]["count"]
+        pages = math.ceil(total_videos / page_size)
 
-        pages = math.ceil(total_videos / 50)
-        tlist = []
-        videos = []
-        total_plays = 0
-        total_comments = 0
-        total_danmaku = 0
-        for pn in range(1, pages+1):
-            data = await self.__get_one_page_videos(mid, pn, 50)
-            if data is None:
-                return None
-
-            if not tlist:
-                for part in data["list"]["tlist"].values():
-                    tlist.append(SubmitVideoDetails.VideoPartitionInfo(
-                        tid=part["tid"], count=part["count"]))
-
-            for video in data["list"]["vlist"]:
-                total_plays += video["play"] if type(
-                    video["play"]) == int else 0
-                total_comments += video["comment"]
-                total_danmaku += video["video_review"]
-                videos.append(SubmitVideoDetails.VideoInfo(
-                    avid=video["aid"],
-                    bvid=video["bvid"],
-                    title=video["title"],
-                    # desc=video["description"],
-                    comments=video["comment"],
-                    plays=video["play"],
-                    danmaku=video["video_review"],
-                    tid=video["typeid"],
-                    created=video["created"],
-                    # "127:31" min:sec
-                    duration=sum(map(int, video["length"].split(":"))),
-                    is_union=bool(video["is_union_video"])
-                ))
-
-        return SubmitVideoDetails(
-            total_videos=total_videos,
-            total_plays=total_plays,
-            total_comments=total_comments,
-            total_danmaku=total_danmaku,
-            partition=tlist,
-            videos=videos
-        )
+        # fetch the rest pages concurrently, but not too many at the same time for one up
+        semaphore = asyncio.Semaphore(self._video_page_concurrency)
+
+        async def get_page(pn: int):
+            async with semaphore:
+                return await self.__get_one_page_videos(mid, pn, page_size)
+
+        rest_pages = await self.__gather_or_cancel(*(get_page(pn) for pn in range(2, pages+1)))
+        if rest_pages is None:
+            return None
+
+        details = SubmitVideoDetails(total_videos, 0, 0, 0, partition=[], videos=[])
+        for data in [first_page, *rest_pages]:  # in page order
+            details.videos.extend(self.__add_video_page(details, data))
+        return details
+
+    async def iter_video_pages(self, mid: int) -> AsyncIterator[Optional[dict]]:
+        """
+        Yield the video pages of an up in page order, None if a page failed.
+        Only `video_page_concurrency` pages are fetched ahead, so the memory is bounded.
+        """
+        page_size = 50
+        first_page = await self.__get_one_page_videos(mid, 1, page_size)
+        yield first_page
+        if first_page is None:
+            return
+        pages = math.ceil(first_page["page"]["count"] / page_size)
+
+        next_page = 2
+        fetching = deque()
+        try:
+            while next_page <= pages or fetching:
+                while next_page <= pages and len(fetching) < self._video_page_concurrency:
+                    fetching.append(asyncio.ensure_future(self.__get_one_page_videos(mid, next_page, page_size)))
+                    next_page += 1
+                data = await fetching.popleft()
+                yield data
+                if data is None:
+                    return
+        finally:
+            for task in fetching:
+                task.cancel()
+
+    async def stream_submit_video_details(self, mid: int) -> Optional[SubmitVideoDetails]:
+        """
+        Like get_submit_video_details, but the videos are written to storage page by page
+        instead of kept in memory, the returned details have the totals only.
+        """
+        details = None
+        pages = self.iter_video_pages(mid)
+        try:
+            async for data in pages:
+                if data is None:
+                    return None
+                if details is None:
+                    details = SubmitVideoDetails(data["page"]["count"], 0, 0, 0, partition=[], videos=[])
+                videos = self.__add_video_page(details, data)
+                await storage.write_videos(mid, videos, self._save_path)
+        finally:
+            await pages.aclose()
+        return details
 
     async def __get_one_page_followings(self, mid: int, page: int, page_size: int) -> Set[int]:
         api = "https://api.bilibili.com/x/relation/followings"
@@ -143,27 +201,44 @@ class UpInfoSpider:
                 break
         return total_followings
 
-    async def get_up_info(self, mid: int) -> Optional[UpInfo]:
-        relation = await self.get_relation_info(mid)
+    async def get_up_info(self, mid: int, relation: Optional[RelationInfo] = None) -> Optional[UpInfo]:
+        relation = relation or await self.get_relation_info(mid)
         if not relation:
             await self._mid_pool.add_failed_mid(mid)
             return None
 
         if relation.follower < config.SPIDER_FILTER["min_follower"]:
             logger.info(f"Drop {mid=}, {relation=}")
-            await self._mid_pool.add_processed_mid(mid)  # dropping data also considered successful
+            await self._mid_pool.add_dropped_mid(mid, relation.follower)  # dropping data also considered successful
             return None
 
-        base_info = await self.get_base_user_info(mid)
-        charge_info = await self.get_charge_info(mid)
-        video_detials = await self.get_submit_video_details(mid)
-
-        if not all([base_info, charge_info, video_detials]):
+        info = await self.__get_up_details(mid, relation)
+        if not info:
             await self._mid_pool.add_failed_mid(mid)
             return None
 
-        logger.info(f"Accept {mid=}, name={base_info.name}, {relation=}")
-        await self._mid_pool.add_processed_mid(mid)
+        logger.info(f"Accept {mid=}, name={info.base.name}, {relation=}")
+        return info  # acked by the caller once it's written
+
+    async def __get_up_details(self, mid: int, relation: RelationInfo) -> Optional[UpInfo]:
+        if self._stream_videos:
+            # videos are written while fetched, fetch the others first so a failed up writes nothing
+            details = await self.__gather_or_cancel(
+                self.get_base_user_info(mid),
+                self.get_charge_info(mid)
+            )
+            if details:
+                details.append(await self.stream_submit_video_details(mid))
+        else:
+            details = await self.__gather_or_cancel(
+                self.get_base_user_info(mid),
+                self.get_charge_info(mid),
+                self.get_submit_video_details(mid)
+            )
+        if not details or details[-1] is None:
+            return None
+
+        base_info, charge_info, video_detials = details
         return UpInfo(
             base=base_info,
             relation=relation,
@@ -171,19 +246,57 @@ class UpInfoSpider:
             video=video_detials
         )
 
+    @staticmethod
+    async def __gather_or_cancel(*aws: Awaitable, stop_on_none: bool = True) -> Optional[List]:
+        """
+        Run aws concurrently, cancel the others once one of them raises,
+        or returns None if `stop_on_none` (then None is returned)
+        """
+        tasks = [asyncio.ensure_future(aw) for aw in aws]
+        try:
+            for future in asyncio.as_completed(tasks):
+                if await future is None and stop_on_none:
+                    return None
+            return [task.result() for task in tasks]
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    @staticmethod
+    def __followings_score(relation: RelationInfo) -> float:
+        # the followings of popular ups are more likely to be popular, crawl them first.
+        # a mid followed by many ups gets the score added up
+        return 1.0 + math.log10(relation.follower + 1)
+
     async def process_up_info(self, mid: int):
+        start = time.perf_counter()
         try:
-            # find up's followings
-            followings = await self.get_followings(mid)
-            await self._mid_pool.add_mid_set(followings)
-            # fetch up details and save to disk
-            info = await self.get_up_info(mid)
+            relation = await self.get_relation_info(mid)
+            if not relation:
+                await self._mid_pool.add_failed_mid(mid)
+                return
+            # find up's followings and fetch up details at the same time
+            # the other is cancelled if one raises, a dropped up still has its followings added
+            _, info = await self.__gather_or_cancel(
+                self.__add_followings(mid, relation),
+                self.get_up_info(mid, relation),
+                stop_on_none=False
+            )
             if not info: # dropped
                 return
-            await storage.write(info.to_json(ensure_ascii=False), self._save_path)
+            # save to disk, then ack, or the mid is marked processed but its record lost
+            await storage.write_up_info(info, self._save_path)
+            await self._mid_pool.add_processed_mid(mid)
         except Exception as e:
             await self._mid_pool.add_failed_mid(mid)
             logger.exception(e)
+        finally:
+            self._latency.record(time.perf_counter() - start)
+
+    async def __add_followings(self, mid: int, relation: RelationInfo):
+        followings = await self.get_followings(mid)
+        await (self._router or self._mid_pool).add_mid_set(followings, self.__followings_score(relation))
 
     async def __single_spider_task(self, tid: int):
         while True:
@@ -198,7 +311,10 @@ class UpInfoSpider:
         await asyncio.gather(*tasks)
 
     async def run_with_mids(self, mids: Set[int]):
-        self._mid_pool.init()
+        self._mid_pool.init(before_flush=storage.flush)
+        if self._router:
+            self._router.init(self._mid_pool)
+            mids = self._router.filter_owned(mids)
         await self._mid_pool.add_mid_set(mids)  # seed mids
         await self._client.init()
         
@@ -206,9 +322,118 @@ class UpInfoSpider:
         try:
             task = asyncio.create_task(self.__parallel_spider_task())
             while True:
-                await asyncio.sleep(1)
-        except KeyboardInterrupt:
+                await asyncio.wait({task}, timeout=self._report_interval)
+                if task.done():
+                    task.result()  # the workers stopped on an error, like the MidPool failed to load
+                self._latency.report()
+                self._client.report()
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            # let the processing mids finish, or they are lost
+            await self._mid_pool.drain(self._drain_timeout)
             task.cancel()
         finally:
             await self._client.close()
+            await storage.close()
+            if self._router:
+                await self._router.stop()
             self._mid_pool.stop()
+
+
+    async def recrawl_up_info(self, mid: int, scheduler: RecrawlScheduler):
+        """Crawl a saved up again, the followings are not needed, they are known since the last crawl"""
+        start = time.perf_counter()
+        try:
+            relation = await self.get_relation_info(mid)
+            info = relation and await self.__get_up_details(mid, relation)
+            if not info:
+                scheduler.failed(mid)
+                return
+            scheduler.update(mid, relation.follower, info.video.total_videos)
+            await storage.write_up_info(info, self._save_path)
+        except Exception as e:
+            scheduler.failed(mid)
+            logger.exception(e)
+        finally:
+            self._latency.record(time.perf_counter() - start)
+
+    async def __single_recrawl_task(self, scheduler: RecrawlScheduler):
+        while True:
+            mid = await scheduler.get_due_mid()
+            await self.recrawl_up_info(mid, scheduler)
+
+    async def run_recrawl(self):
+        """
+        Keep the saved ups fresh instead of crawling everything again,
+        only the due ups are crawled, within the budget of requests per hour.
+        """
+        backend = config.STORAGE.get("backend")
+        if backend != "local":
+            raise ValueError(f"Recrawl scans the json lines saved by the local storage, can't scan {backend=}")
+        # the cached responses are not older than the min interval, they never show a change
+        self._client = HttpClient(use_cache=False)
+        scheduler = RecrawlScheduler(**config.RECRAWL)
+        # the ups saved by a multi-process crawl are in the shard files
+        await scheduler.load([self._save_path, *find_shard_paths(self._save_path)])
+        await self._client.init()
+
+        tasks = []
+        try:
+            tasks = [asyncio.create_task(self.__single_recrawl_task(scheduler))
+                     for _ in range(self._parallel_co_tasks)]
+            last_save = time.monotonic()
+            while True:
+                await asyncio.sleep(self._report_interval)
+                self._latency.report()
+                self._client.report()
+                scheduler.report()
+                if time.monotonic() - last_save >= scheduler.save_interval:
+                    await scheduler.save()
+                    last_save = time.monotonic()
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            for task in tasks:
+                task.cancel()
+        finally:
+            await scheduler.save()  # the ups in process are still due, crawled again in the next run
+            await self._client.close()
+            await storage.close()
+
+
+def _run_shard(shard_id: int, inboxes: List[multiprocessing.Queue], mids: Set[int]):
+    configure_shard(shard_id)
+    # a peer may exit before reading the last batches sent to it, they are dropped,
+    # or the feeder thread blocks this process from exiting
+    for i, inbox in enumerate(inboxes):
+        if i != shard_id:
+            inbox.cancel_join_thread()
+    spider = UpInfoSpider(ShardRouter(shard_id, inboxes))
+    try:
+        asyncio.run(spider.run_with_mids(mids))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_sharded(mids: Set[int], processes: int):
+    """
+    Crawl with multiple processes to use all the cores, each process has its own event loop,
+    HttpClient and MidPool, and owns a hash shard of mids. Followings are routed to the owning shard.
+    """
+    inboxes = [multiprocessing.Queue() for _ in range(processes)]
+    workers = [
+        multiprocessing.Process(target=_run_shard, args=(i, inboxes, mids), name=f"UpInfoShard-{i}")
+        for i in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    logger.info(f"Started {processes} shard processes")
+    deadline = None  # set on Ctrl-C
+    for worker in workers:
+        while worker.is_alive():
+            try:
+                worker.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+            except KeyboardInterrupt:
+                # the workers get it too, wait for them to drain
+                deadline = deadline or time.monotonic() + config.SHARD["exit_timeout"]
+            if deadline is not None and time.monotonic() >= deadline and worker.is_alive():
+                logger.error(f"{worker.name} is not stopped in time, terminate it")
+                worker.terminate()
+                worker.join()
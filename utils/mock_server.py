@@ -0,0 +1,248 @@
+import asyncio
+import math
+import random
+import time
+from collections import Counter, deque
+from typing import Deque, Dict
+from aiohttp import web
+import config
+from utils.log import logger
+
+__all__ = ["MockBilibiliServer"]
+
+_MASK = 0xFFFFFFFFFFFFFFFF
+
+
+def _uniform(mid: int, salt: int) -> float:
+    """A random number in [0, 1) decided by (mid, salt), so the graph is the same without storing it"""
+    x = (mid * 0x9E3779B97F4A7C15 + salt * 0xBF58476D1CE4E5B9) & _MASK
+    # splitmix64 finalizer
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK
+    x ^= x >> 31
+    return x / 2 ** 64
+
+
+class MockBilibiliServer:
+    """
+    A stand-in of the Bilibili api over a synthetic social graph, for load testing without being banned.
+    Serves the endpoints of UpInfoSpider and GuichuInfoSpider, with latency and 412/-412 injected,
+    and a fake proxy vendor: every proxy is another port of this server, banned when it's too fast.
+    """
+
+    def __init__(self, users: int, follower_alpha: float, max_followings: int, no_charge_rate: float,
+                 latency_median: float, latency_sigma: float, http_412_rate: float, code_412_rate: float,
+                 rate_limit: float, ban_duration: float, proxies: int, proxy_ttl: int):
+        self._users = users
+        self._follower_alpha = follower_alpha  # larger alpha, more popular ups
+        self._max_followings = max_followings
+        self._no_charge_rate = no_charge_rate
+        self._latency_mu = math.log(latency_median)  # latency is log-normal distributed
+        self._latency_sigma = latency_sigma
+        self._http_412_rate = http_412_rate
+        self._code_412_rate = code_412_rate
+        self._rate_limit = rate_limit  # requests per second of a client ip (port here), 0 for no limit
+        self._ban_duration = ban_duration
+        self._proxies = proxies
+        self._proxy_ttl = proxy_ttl
+        self._proxy_ports = []
+        self._recent: Dict[int, Deque[float]] = {}  # client -> request times in the last second
+        self._banned_until: Dict[int, float] = {}
+        self._runner = None
+        self.requests = Counter()  # endpoint -> requests
+        self.responses = Counter()  # "200"/"412"/"-412"/"88214"...
+
+    # ---------- synthetic graph ----------
+
+    def __exists(self, mid: int) -> bool:
+        return 1 <= mid <= self._users
+
+    def __follower(self, mid: int) -> int:
+        # pareto distributed, the smaller mids are more likely to be popular
+        u = max(_uniform(mid, 1) * math.sqrt(mid / self._users), 1e-12)
+        return min(int(10 / u ** self._follower_alpha), 10 ** 8)
+
+    def __following(self, mid: int) -> int:
+        return int(_uniform(mid, 2) * self._max_followings)
+
+    def __videos(self, mid: int) -> int:
+        return min(int(math.sqrt(self.__follower(mid)) * _uniform(mid, 3)), 5000)
+
+    def __following_mid(self, mid: int, i: int) -> int:
+        # following the popular ups more
+        return 1 + int(self._users * _uniform(mid, 100 + i) ** 3)
+
+    # ---------- api ----------
+
+    @staticmethod
+    def __ok(data) -> web.Response:
+        return web.json_response({"code": 0, "message": "0", "ttl": 1, "data": data})
+
+    @staticmethod
+    def __error(code: int, message: str) -> web.Response:
+        return web.json_response({"code": code, "message": message, "ttl": 1})
+
+    async def __acc_info(self, request: web.Request) -> web.Response:
+        mid = int(request.query["mid"])
+        if not self.__exists(mid):
+            return self.__error(-404, "啥都木有")
+        return self.__ok({
+            "mid": mid,
+            "name": f"mock_up_{mid}",
+            "sex": ("男", "女", "保密")[mid % 3],
+            "face": f"http://i0.hdslb.com/bfs/face/{mid}.jpg",
+            "sign": f"签名 {mid}",
+            "level": mid % 7,
+            "vip": {"type": mid % 3},
+            "official": {"role": 0, "title": ""},
+            "silence": 0,
+            "school": None,
+            "birthday": "01-01",
+            "is_senior_member": 0
+        })
+
+    async def __relation_stat(self, request: web.Request) -> web.Response:
+        mid = int(request.query["vmid"])
+        if not self.__exists(mid):
+            return self.__error(-404, "啥都木有")
+        return self.__ok({"mid": mid, "following": self.__following(mid), "follower": self.__follower(mid)})
+
+    async def __charge(self, request: web.Request) -> web.Response:
+        mid = int(request.query["up_mid"])
+        if _uniform(mid, 4) < self._no_charge_rate:
+            return self.__error(88214, "up主未开通充电")
+        follower = self.__follower(mid)
+        return self.__ok({"count": follower // 1000, "total_count": follower // 100})
+
+    async def __videos_page(self, request: web.Request) -> web.Response:
+        mid = int(request.query["mid"])
+        pn = int(request.query.get("pn", 1))
+        ps = int(request.query.get("ps", 30))
+        total = self.__videos(mid)
+        vlist = []
+        for i in range((pn - 1) * ps, min(pn * ps, total)):
+            aid = mid * 10000 + i
+            vlist.append({
+                "aid": aid,
+                "bvid": f"BV{aid:010d}",
+                "title": f"视频 {i}",
+                "comment": i % 100,
+                "play": i * 10 if i % 20 else "--",  # the plays of some videos are hidden
+                "video_review": i % 50,
+                "typeid": 17 + i % 5,
+                "created": 1600000000 + i * 3600,
+                "length": f"{i % 60}:{i % 60:02d}",
+                "is_union_video": i % 10 == 0
+            })
+        tlist = {str(17 + t): {"tid": 17 + t, "count": total // 5, "name": "mock"} for t in range(5)} if total else {}
+        return self.__ok({"list": {"tlist": tlist, "vlist": vlist}, "page": {"pn": pn, "ps": ps, "count": total}})
+
+    async def __followings(self, request: web.Request) -> web.Response:
+        mid = int(request.query["vmid"])
+        pn = int(request.query.get("pn", 1))
+        ps = int(request.query.get("ps", 50))
+        if pn > 5:
+            return self.__error(22007, "限制只访问前5页")
+        total = self.__following(mid)
+        followings = [{"mid": self.__following_mid(mid, i)} for i in range((pn - 1) * ps, min(pn * ps, total))]
+        return self.__ok({"list": followings, "total": total})
+
+    async def __guichu(self, request: web.Request) -> web.Response:
+        offset = int(request.query.get("offset") or 0)
+        size = int(request.query.get("page_size", 30))
+        items = [{"name": f" 鬼畜视频 {i} "} for i in range(offset, offset + size)]
+        # the data is returned directly
+        return self.__ok({"offset": str(offset + size), "list": items})
+
+    async def __proxy_vendor(self, request: web.Request) -> web.Response:
+        # the response of juliang
+        num = int(request.query.get("num", 10))
+        ports = random.sample(self._proxy_ports, min(num, len(self._proxy_ports)))
+        proxy_list = [f"127.0.0.1:{port},{self._proxy_ttl}" for port in ports]
+        return web.json_response({"code": 200, "msg": "请求成功", "data": {"count": len(ports), "proxy_list": proxy_list}})
+
+    async def __stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"requests": self.requests, "responses": self.responses})
+
+    # ---------- fault injection ----------
+
+    def __limited(self, client: int) -> bool:
+        """Ban the client who sends requests faster than the limit, like the real api"""
+        now = time.monotonic()
+        if self._banned_until.get(client, 0) > now:
+            return True
+        if not self._rate_limit:
+            return False
+        recent = self._recent.setdefault(client, deque())
+        recent.append(now)
+        while recent[0] <= now - 1:
+            recent.popleft()
+        if len(recent) > self._rate_limit:
+            self._banned_until[client] = now + self._ban_duration
+            recent.clear()
+            return True
+        return False
+
+    @web.middleware
+    async def __inject(self, request: web.Request, handler) -> web.Response:
+        path = request.rel_url.path
+        if path.startswith("/_") or path.startswith("/dynamic/"):
+            return await handler(request)
+        self.requests[path] += 1
+        # the port a request comes in is the ip of client, every proxy has a port
+        client = request.transport.get_extra_info("sockname")[1]
+        await asyncio.sleep(random.lognormvariate(self._latency_mu, self._latency_sigma))
+        if self.__limited(client) or random.random() < self._http_412_rate:
+            self.responses["412"] += 1
+            return web.Response(status=412, text="412 Precondition Failed")
+        if random.random() < self._code_412_rate:
+            self.responses["-412"] += 1
+            return self.__error(-412, "请求被拦截")
+        response = await handler(request)
+        self.responses[str(response.status)] += 1
+        return response
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.__inject])
+        app.router.add_get("/x/space/acc/info", self.__acc_info)
+        app.router.add_get("/x/relation/stat", self.__relation_stat)
+        app.router.add_get("/x/ugcpay-rank/elec/month/up", self.__charge)
+        app.router.add_get("/x/space/arc/search", self.__videos_page)
+        app.router.add_get("/x/relation/followings", self.__followings)
+        app.router.add_get("/api/web/channel/featured/list", self.__guichu)
+        app.router.add_get("/dynamic/getips", self.__proxy_vendor)
+        app.router.add_get("/_stats", self.__stats)
+        return app
+
+    async def start(self, host: str, port: int):
+        """Serve the api at port, and the fake proxies at the ports after it"""
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        # a proxy gets the absolute url and handles it itself, as if it was forwarded
+        self._proxy_ports = list(range(port + 1, port + 1 + self._proxies))
+        for proxy_port in self._proxy_ports:
+            await web.TCPSite(self._runner, host, proxy_port).start()
+        logger.info(f"Mock Bilibili api is running at http://{host}:{port}, {self._proxies} proxies")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+# ============ for test ===============
+
+
+if __name__ == "__main__":
+    async def main():
+        server = MockBilibiliServer(**config.MOCK_SERVER["api"])
+        await server.start(config.MOCK_SERVER["host"], config.MOCK_SERVER["port"])
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await server.stop()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
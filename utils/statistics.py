@@ -3,7 +3,7 @@ import time
 from threading import Thread
 from multiprocessing import Queue  # for PIC
 
-__all__ = ["statistics"]
+__all__ = ["statistics", "LatencyRecorder"]
 
 
 class Statistics:
@@ -63,6 +63,44 @@ class Statistics:
         logger.info("Statistics stopped")
 
 
+class LatencyRecorder:
+    """Collect latency samples and summarize them by percentiles"""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._samples = []
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def summary(self, reset: bool = True) -> dict:
+        samples = sorted(self._samples)
+        if reset:
+            self._samples = []
+        if not samples:
+            return {"count": 0}
+
+        def percentile(p: float) -> float:
+            return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+        return {
+            "count": len(samples),
+            "avg": sum(samples) / len(samples),
+            "p50": percentile(0.5),
+            "p90": percentile(0.9),
+            "p99": percentile(0.99),
+            "max": samples[-1]
+        }
+
+    def report(self):
+        summary = self.summary()
+        if summary["count"] == 0:
+            return
+        logger.info(f"Latency of {self._name}: count={summary['count']}, avg={summary['avg']:.3f}s, "
+                    f"p50={summary['p50']:.3f}s, p90={summary['p90']:.3f}s, p99={summary['p99']:.3f}s, "
+                    f"max={summary['max']:.3f}s")
+
+
 # global statistics
 statistics = Statistics()
 